@@ -1,12 +1,21 @@
-from flask import Flask, render_template, flash, redirect, url_for, request, g, session, abort
-from wtforms import Form, validators, StringField, SelectField, TextAreaField, IntegerField, PasswordField, SelectMultipleField, widgets
+from flask import Flask, render_template, flash, redirect, url_for, request, g, session, abort, jsonify, Response, stream_with_context, get_flashed_messages, send_from_directory
+from wtforms import Form, validators, StringField, SelectField, TextAreaField, IntegerField, PasswordField, SelectMultipleField, DateField, widgets
 import datetime as dt
 import os
+import sys
+import time
+import json
+import mimetypes
+import sqlite3
 import pandas as pd
-from flask_sqlalchemy import SQLAlchemy
 from functools import wraps
-from sqlalchemy.exc import IntegrityError
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm.exc import StaleDataError
 from passlib.hash import sha256_crypt
+from routing import RoutingSQLAlchemy, replica_configured, make_sticky
 
 app = Flask(__name__)
 
@@ -17,18 +26,47 @@ assert "ADMIN_PWD" in os.environ, "ADMIN_PWD environment variable not set"
 assert "DATABASE_URL" in os.environ, "DATABASE_URL environment variable not set"
 app.config.from_object(os.environ['APP_SETTINGS'])
 
-#Configure postgresql database:
-db = SQLAlchemy(app)
-from models import Partners, Work_Packages, Deliverables, Users, Users2Work_Packages, Tasks, Users2Partners, Tasks2Deliverables
+#Cache compiled templates on disk, so new workers don't have to recompile them:
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])
 
-#Set any other parameters:
-endMonth = 51 #End month (from project start month)
+#Configure database (postgresql, or sqlite for single-node deployments), with reads sent to
+#the replica given by DATABASE_READ_URL (if any) - see routing.py:
+db = RoutingSQLAlchemy(app)
+
+#Set up sqlite connections: write-ahead logging (readers don't block the writer), fewer
+#fsyncs, and foreign key enforcement (off by default in sqlite):
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+from models import Projects, Partners, Work_Packages, Deliverables, Users, Users2Work_Packages, Tasks, Users2Partners, Tasks2Deliverables, Progress_Snapshots, Digests, Report_Jobs, Task_Work_Packages
+
+#Tables shared by all projects (every other table is scoped by project_id):
+globalTables = ['Projects', 'Users']
 
 ########## PSQL FUNCTIONS ##########
-def psql_to_pandas(query):
-    df = pd.read_sql(query.statement,db.session.bind)
+def psql_to_pandas(query,bind=None):
+    if bind is None:
+        bind = db.session().get_bind() #Replica or primary, depending on the request
+    df = pd.read_sql(query.statement,bind)
     return df
 
+def psql_rows(query,drop=(),params=None):
+    #Column names and an iterator over the rows (as plain tuples, with None as ""), streamed
+    #from the database rather than loaded all at once. query is a Query, or a prebuilt statement
+    #and its parameters (see dal.py):
+    statement = getattr(query,'statement',query)
+    result = db.session.connection().execution_options(stream_results=True).execute(statement,params or {})
+    names = list(result.keys())
+    keep = [i for i,name in enumerate(names) if name not in drop]
+    rows = (tuple("" if row[i] is None else row[i] for i in keep) for row in result)
+    return [names[i] for i in keep], rows
+
 def psql_insert(row,flashMsg=True):
     try:
         db.session.add(row)
@@ -50,6 +88,32 @@ def psql_delete(row,flashMsg=True):
         db.session.rollback()
         flash('Integrity Error: Cannot delete, other database entries likely reference this one', 'danger')
     return
+
+def psql_update(row,form):
+    #Optimistic concurrency: only save the edits if the row is still at the version the edit form
+    #was loaded with (the UPDATE checks the version again, so no locks are held between requests).
+    #Returns False (leaving the row unchanged) if someone else has edited it in the meantime:
+    if str(row.version) != request.form.get('version'):
+        return False
+    for field in form:
+        exec("row."+field.name+" = field.data")
+    try:
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        return False
+    return True
+
+def merge_view(row,form,title,action,nReadonly):
+    #Show the user's edits next to the current values of a row that changed while they were editing:
+    current = dict((field.name, getattr(row,field.name)) for field in form)
+    text = lambda value: '' if value is None else str(value)
+    changed = [field.name for field in form if text(field.data) != text(current[field.name])]
+    for i,field in enumerate(form):
+        if i<nReadonly:
+            field.render_kw = {'readonly': 'readonly'}
+    flash('This entry was changed by someone else while you were editing it', 'danger')
+    return render_template('merge.html',title=title,form=form,current=current,changed=changed,action=action,version=row.version), 409
 ####################################
 
 ########## LOGGED-IN FUNCTIONS ##########
@@ -74,37 +138,206 @@ def is_logged_in_as_admin(f):
             flash('Unauthorised, please login as admin', 'danger')
             return redirect(url_for('index'))
     return wrap
+
+#Run a slow CPU-bound call (e.g. password hashing) in a real thread when running under
+#gevent/eventlet gunicorn workers, so the worker can carry on serving other requests:
+def offload(fn,*args):
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('socket'):
+        import gevent
+        return gevent.get_hub().threadpool.apply(fn,args)
+    patcher = sys.modules.get('eventlet.patcher')
+    if patcher is not None and patcher.is_monkey_patched('socket'):
+        from eventlet import tpool
+        return tpool.execute(fn,*args)
+    return fn(*args)
+#########################################
+
+########## PROJECT FUNCTIONS ##########
+#Time spent on the CPU by each request, in the X-CPU-Time response header (milliseconds), for
+#the load test (see loadtest.py). It's the process's CPU time, so it only covers the request
+#alone with one request per worker (GUNICORN_WORKER_CLASS=sync), and for streamed pages it stops
+#when the first chunk is ready:
+@app.before_request
+def start_cpu_time():
+    if app.config['CPU_TIME_HEADER']:
+        g.cpuStart = time.process_time()
+
+@app.after_request
+def cpu_time_header(response):
+    if 'cpuStart' in g:
+        response.headers['X-CPU-Time'] = '%.2f' % ((time.process_time()-g.cpuStart)*1000)
+    return response
+
+#Pages that work without an active project (besides adding, uploading, viewing, editing and
+#deleting projects and users), e.g. on a fresh database before the first project is added:
+projectFreeEndpoints = ['index', 'login', 'logout', 'change_pwd', 'switch_project']
+
+#Load the active project (chosen via /project/<id>, else the first project):
+@app.before_request
+def load_project():
+    if request.endpoint == 'static':
+        return
+    g.project = None
+    if 'project_id' in session:
+        g.project = get_row(Projects,session['project_id'])
+    if g.project is None:
+        g.project = Projects.query.order_by(Projects.id).first()
+    if g.project is None and request.endpoint not in projectFreeEndpoints \
+            and (request.view_args or {}).get('tableClass') not in globalTables:
+        if session.get('username') == 'admin':
+            flash('There are no projects yet, please add one', 'danger')
+            return redirect(url_for('add',tableClass='Projects'))
+        flash('There are no projects yet', 'danger')
+        return redirect(url_for('index'))
+
+#After a user writes, read their requests from the primary for a while (see routing.py):
+@app.after_request
+def stick_to_primary(response):
+    if replica_configured(app) and request.method not in ('GET','HEAD') and request.endpoint != 'static':
+        make_sticky(app)
+    return response
+
+#Make all projects available to templates (for the project switcher):
+@app.context_processor
+def inject_projects():
+    return dict(projects=Projects.query.order_by(Projects.id).all())
+
+#Query for a table, restricted to the active project where the table is project-scoped:
+def project_query(tableClass):
+    query = eval(tableClass).query
+    if tableClass not in globalTables:
+        query = query.filter_by(project_id=g.project.id)
+    return query
+
+#Row by id, in the active project where the table is project-scoped (None if there isn't one):
+def project_row(tableClass,id):
+    return get_row(eval(tableClass),id,None if tableClass in globalTables else g.project.id)
 #########################################
 
 ########## MISC FUNCTIONS ##########
 def table_list(tableClass,col):
-    DF = psql_to_pandas(eval(tableClass).query.order_by(eval(tableClass).id))
+    #Choice lists can come from the replica, even when a form is being submitted:
+    DF = psql_to_pandas(project_query(tableClass).order_by(eval(tableClass).id),db.read_engine())
     list = [('blank','--Please select--')]
     for element in DF[col]:
         list.append((element,element))
     return list
 
-def tasksPerWP(wp_code):
-    deliverables = psql_to_pandas(Deliverables.query.filter_by(work_package=wp_code).order_by(Deliverables.id))
-    tasks = []
-    for deliverable in deliverables['code']:
-        tasks4ThisDeliv = psql_to_pandas(Tasks2Deliverables.query.filter_by(deliverable=deliverable).order_by(Tasks2Deliverables.id))
-        for task in tasks4ThisDeliv['task']:
-            if task not in tasks:
-                tasks.append(task)
-    return tasks
-
-def WPsPerTask(task_code):
-    deliverables = psql_to_pandas(Tasks2Deliverables.query.filter_by(task=task_code).order_by(Tasks2Deliverables.id))
-    WPs = []
-    for deliverable in deliverables['deliverable']:
-        WP = Deliverables.query.filter_by(code=deliverable).first().work_package
-        if WP not in WPs:
-            WPs.append(WP)
-    return WPs
+def userWPs(username):
+    #Work packages in the active project that this user is leader of:
+    return user_work_packages(g.project.id,username)
+
+def userPartners(username):
+    #Partners in the active project that this user is leader of:
+    return user_partners(g.project.id,username)
+
+def stream_template(template_name,**context):
+    #Render a template as it is sent (e.g. for pages of many table rows, passed as an iterator):
+    get_flashed_messages(with_categories=True) #Remove flashed messages from the session now, before it is saved
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(50)
+    return Response(stream_with_context(stream))
+
+def currentMonth(project=None):
+    #Project month for today's date, counting the project start month as month 0:
+    if project is None:
+        project = g.project
+    start = project.start_date
+    if start is None:
+        start = dt.datetime.strptime(app.config['PROJECT_START_DATE'],'%Y-%m-%d').date()
+    today = dt.date.today()
+    month = (today.year-start.year)*12 + (today.month-start.month)
+    return min(max(month,0),project.end_month)
+#########################################
+
+from dal import get_row, user_by_username, user_work_packages, user_partners, work_package_deliverables
+from snapshots import take_snapshot, burnup_curves
+from caching import invalidate_caches
+from analytics import at_risk
+from closure import task_work_packages
+from timeline import timeline, timeline_items
+from digests import store_digests, user_digest
+from reports import report_formats, queue_report, recent_jobs, report_chunks, contentTypes
+from assets import load_manifest, choose_encoding, compress, compress_stream
+
+########## STATIC FILES AND COMPRESSION ##########
+#Fingerprinted static file names, if built (see assets.py):
+staticManifest = load_manifest(app.static_folder)
+
+def static_url_for(endpoint,**values):
+    if endpoint == 'static' and values.get('filename') in staticManifest:
+        values['filename'] = staticManifest[values['filename']]
+    return url_for(endpoint,**values)
+
+@app.context_processor
+def inject_static_url_for():
+    return dict(url_for=static_url_for)
+
+#Serve static files precompressed where possible, and fingerprinted files with far-future caching:
+def static_file(filename):
+    mimetype = mimetypes.guess_type(filename)[0]
+    encoding = choose_encoding(request.accept_encodings)
+    ext = {'br': '.br', 'gzip': '.gz'}.get(encoding)
+    if ext and os.path.isfile(os.path.join(app.static_folder,filename+ext)):
+        response = send_from_directory(app.static_folder,filename+ext,mimetype=mimetype)
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = send_from_directory(app.static_folder,filename,mimetype=mimetype)
+    response.vary.add('Accept-Encoding')
+    if filename in staticManifest.values():
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+app.view_functions['static'] = static_file
+
+#Compress HTML and JSON responses (streamed pages as they are sent). Files sent from disk
+#(direct passthrough, e.g. static .json/.html) are left alone, as their body can't be read here:
+@app.after_request
+def compress_response(response):
+    if (response.mimetype not in ('text/html','application/json') or response.status_code != 200
+            or 'Content-Encoding' in response.headers or response.direct_passthrough):
+        return response
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        original = response.response
+        response.response = compress_stream(response.iter_encoded(),encoding)
+        if hasattr(original,'close'):
+            response.call_on_close(original.close)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_BYTES']:
+            return response
+        response.set_data(compress(data,encoding))
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
 #########################################
 
 ########## FORM CLASSES ##########
+class ProjectMonth(object):
+    #Validate a month against the active project's end month:
+    def __call__(self, form, field):
+        endMonth = g.project.end_month
+        validators.NumberRange(min=0,max=endMonth,message="Must be between 0 and "+str(endMonth))(form, field)
+
+class Projects_Form(Form):
+    code = StringField(u'*Project Code',
+        [validators.InputRequired()],
+        render_kw={"placeholder": "e.g. SWIFT"})
+    name = StringField(u'*Name',
+        [validators.InputRequired()],
+        render_kw={"placeholder": "e.g. GCRF African SWIFT"})
+    end_month = IntegerField(u'*End Month',
+        [validators.NumberRange(min=0,message="Must be 0 or more")])
+    start_date = DateField(u'Start Date (of month 0)',
+        validators=[validators.Optional()],
+        render_kw={"placeholder": "YYYY-MM-DD"})
+
 class Partners_Form(Form):
     name = StringField(u'*Partner Name',
         [validators.InputRequired()],
@@ -136,7 +369,7 @@ different timescales in each sector."})
     responsible_partner = SelectField(u'*Responsible Partner',
         [validators.NoneOf(('blank'),message='Please select')])
     month_due = IntegerField(u'Month Due',
-        [validators.NumberRange(min=0,max=endMonth,message="Must be between 0 and "+str(endMonth))])
+        [ProjectMonth()])
     progress = TextAreaField(u'Progress',
         validators=[validators.Optional()])
     percent = IntegerField(u'*Percentage Complete',
@@ -190,7 +423,7 @@ template for baselining the current provision of forecasts."})
     responsible_partner = SelectField(u'*Responsible Partner',
         [validators.NoneOf(('blank'),message='Please select')])
     month_due = IntegerField(u'Month Due',
-        [validators.NumberRange(min=0,max=endMonth,message="Must be between 0 and "+str(endMonth))])
+        [ProjectMonth()])
     progress = TextAreaField(u'Progress',
         validators=[validators.Optional()])
     percent = IntegerField(u'*Percentage Complete',
@@ -206,6 +439,10 @@ class Alt_Tasks_Form(Form):
     percent = IntegerField(u'*Percentage Complete',
         [validators.NumberRange(min=0,max=100,message="Must be between 0 and 100")])
 
+class ReportForm(Form):
+    file_format = SelectField(u'Format')
+    scope = SelectField(u'Report on')
+
 class Tasks2Deliverables_Form(Form):
     task = SelectField(u'*Task',
         [validators.NoneOf(('blank'),message='Please select')])
@@ -213,16 +450,22 @@ class Tasks2Deliverables_Form(Form):
         [validators.NoneOf(('blank'),message='Please select')])
 #########################################
 
+from bulkload import uploadModes, read_rows, validate_rows, apply_rows
+
 #Index
 @app.route('/')
 def index():
-    return render_template('home.html')
+    #Stored digest of the user's overdue and soon-due items (see digests.py):
+    digest = []
+    if 'logged_in' in session and g.project is not None:
+        digest = user_digest(g.project,session['username'])
+    return render_template('home.html',digest=digest)
 
 #Add entry
 @app.route('/add/<string:tableClass>', methods=["GET","POST"])
 @is_logged_in_as_admin
 def add(tableClass):
-    if tableClass not in ['Partners', 'Work_Packages', 'Deliverables', 'Users', 'Tasks', 'Tasks2Deliverables']:
+    if tableClass not in ['Projects', 'Partners', 'Work_Packages', 'Deliverables', 'Users', 'Tasks', 'Tasks2Deliverables']:
         abort(404)
     #Get form (and tweak where necessary):
     form = eval(tableClass+"_Form")(request.form)
@@ -239,7 +482,7 @@ def add(tableClass):
     if request.method == 'POST' and form.validate():
         #Get form fields:
         if tableClass=='Users':
-            form.password.data = sha256_crypt.encrypt(str(form.password.data))
+            form.password.data = offload(sha256_crypt.encrypt,str(form.password.data))
         formdata=[]
         db_string = ""
         for f,field in enumerate(form):
@@ -248,33 +491,76 @@ def add(tableClass):
         #Add to DB:
         db_string = tableClass+"("+db_string[:-1]+")"
         db_row = eval(db_string)
+        if tableClass not in globalTables:
+            db_row.project_id = g.project.id
         psql_insert(db_row)
         return redirect(url_for('add',tableClass=tableClass))
     return render_template('add.html',title=title,tableClass=tableClass,form=form)
 
+#Bulk upload entries from a .tab/.csv file
+@app.route('/upload/<string:tableClass>', methods=["GET","POST"])
+@is_logged_in_as_admin
+def upload(tableClass):
+    if tableClass not in ['Projects', 'Partners', 'Work_Packages', 'Deliverables', 'Users', 'Tasks', 'Tasks2Deliverables']:
+        abort(404)
+    title = "Upload to "+tableClass.replace("_"," ")
+    fieldNames = [field.name for field in eval(tableClass+"_Form")()]
+    errors = []
+    #If user submits a file:
+    if request.method == 'POST':
+        fileStorage = request.files.get('file')
+        if fileStorage is None or fileStorage.filename == '':
+            flash('Please choose a file', 'danger')
+            return redirect(url_for('upload',tableClass=tableClass))
+        mode = request.form.get('mode','insert')
+        if mode not in uploadModes:
+            abort(400)
+        #Validate every row, then apply the valid ones:
+        values, errors = validate_rows(read_rows(fileStorage),tableClass,eval(tableClass),
+            eval(tableClass+"_Form"),g.project.id if g.project is not None else None,mode)
+        if request.form.get('dry_run'):
+            flash(str(len(values))+' valid rows (dry run, nothing saved)', 'success')
+        else:
+            try:
+                apply_rows(tableClass,eval(tableClass),values,mode)
+                #Bulk writes bypass the ORM events that clear cached results (an upload of
+                #Projects can change the months of any project):
+                for projectId in ([p.id for p in Projects.query] if tableClass == 'Projects' else [g.project.id]):
+                    invalidate_caches(projectId)
+                flash(str(len(values))+' rows saved to database', 'success')
+            except IntegrityError:
+                flash('Integrity Error: Violation of unique constraint(s), nothing saved', 'danger')
+            except SQLAlchemyError as e:
+                #e.g. DataError for a value the database column can't hold:
+                flash('Database Error: '+str(getattr(e,'orig',None) or e).split('\n')[0]+', nothing saved', 'danger')
+        if errors:
+            flash(str(len(set(line for line,message in errors)))+' rows had errors and were not saved', 'danger')
+    return render_template('upload.html',title=title,tableClass=tableClass,fieldNames=fieldNames,errors=errors)
+
 #View table
 @app.route('/view/<string:tableClass>')
 @is_logged_in_as_admin
 def view(tableClass):
-    if tableClass not in ['Partners', 'Work_Packages', 'Deliverables', 'Users', 'Tasks', 'Tasks2Deliverables']:
+    if tableClass not in ['Projects', 'Partners', 'Work_Packages', 'Deliverables', 'Users', 'Tasks', 'Tasks2Deliverables']:
         abort(404)
-    #Retrieve all DB data for given table:
-    data = psql_to_pandas(eval(tableClass).query.order_by(eval(tableClass).id))
-    data.fillna(value="", inplace=True)
+    #Retrieve all DB data for given table (in the active project):
+    columns, rows = psql_rows(project_query(tableClass).order_by(eval(tableClass).id),drop=['project_id','version'])
     if tableClass=='Users':
-        data['password'] = '********'
+        rows = ((row[0],row[1],'********') for row in rows)
     #Set title:
     title = "View "+tableClass.replace("_"," ")
     #Set table column names:
-    colnames=[s.replace("_"," ").title() for s in data.columns.values[1:]]
-    return render_template('view.html',title=title,colnames=colnames,tableClass=tableClass,data=data)
+    colnames=[s.replace("_"," ").title() for s in columns[1:]]
+    return stream_template('view.html',title=title,colnames=colnames,tableClass=tableClass,rows=rows)
 
 #Delete entry
-@app.route('/delete/<string:tableClass>/<string:id>', methods=['POST'])
+@app.route('/delete/<string:tableClass>/<int:id>', methods=['POST'])
 @is_logged_in_as_admin
 def delete(tableClass,id):
+    if tableClass not in ['Projects', 'Partners', 'Work_Packages', 'Deliverables', 'Users', 'Tasks', 'Tasks2Deliverables']:
+        abort(404)
     #Retrieve DB entry:
-    db_row = eval(tableClass).query.filter_by(id=id).first()
+    db_row = project_row(tableClass,id)
     if db_row is None:
         abort(404)
     #Delete from DB:
@@ -282,13 +568,13 @@ def delete(tableClass,id):
     return redirect(url_for('view',tableClass=tableClass))
 
 #Edit entry
-@app.route('/edit/<string:tableClass>/<string:id>', methods=['GET','POST'])
+@app.route('/edit/<string:tableClass>/<int:id>', methods=['GET','POST'])
 @is_logged_in_as_admin
 def edit(tableClass,id):
-    if tableClass not in ['Partners', 'Work_Packages', 'Deliverables', 'Tasks', 'Tasks2Deliverables']:
+    if tableClass not in ['Projects', 'Partners', 'Work_Packages', 'Deliverables', 'Tasks', 'Tasks2Deliverables']:
         abort(404)
     #Retrieve DB entry:
-    db_row = eval(tableClass).query.filter_by(id=id).first()
+    db_row = project_row(tableClass,id)
     if db_row is None:
         abort(404)
     #Get form (and tweak where necessary):
@@ -304,10 +590,9 @@ def edit(tableClass,id):
     if request.method == 'POST' and form.validate():
         #Get each form field and update DB:
         if tableClass=='Users':
-            form.password.data = sha256_crypt.encrypt(str(form.password.data))
-        for field in form:
-            exec("db_row."+field.name+" = field.data")
-        db.session.commit()
+            form.password.data = offload(sha256_crypt.encrypt,str(form.password.data))
+        if not psql_update(db_row,form):
+            return merge_view(db_row,form,"Edit "+tableClass[:-1].replace("_"," "),request.path,1)
         #Return with success:
         flash('Edits successful', 'success')
         return redirect(url_for('view',tableClass=tableClass))
@@ -319,115 +604,113 @@ def edit(tableClass,id):
             field.render_kw = {'readonly': 'readonly'}
         if not request.method == 'POST':
             exec("field.data = db_row."+field.name)
-    return render_template('edit.html',title=title,tableClass=tableClass,id=id,form=form)
+    version = request.form.get('version',db_row.version) #Keep the loaded version if the form is redisplayed
+    return render_template('edit.html',title=title,tableClass=tableClass,id=id,form=form,version=version)
 
 #WP list for WP leaders
 @app.route('/wp-list')
 @is_logged_in
 def wp_list():
     #Retrieve all work packages:
-    all_wps = psql_to_pandas(Work_Packages.query.order_by(Work_Packages.id))
+    all_wps = psql_to_pandas(Work_Packages.query.filter_by(project_id=g.project.id).order_by(Work_Packages.id))
+    del all_wps['project_id'], all_wps['version']
     #Select only the accessible work packages for this user:
     if session['username'] == 'admin':
         accessible_wps = all_wps
     else:
-        user_wps = psql_to_pandas(Users2Work_Packages.query.filter_by(username=session['username']))['work_package'].tolist()
+        user_wps = userWPs(session['username'])
         accessible_wps = all_wps[all_wps.code.isin(user_wps)]
     #Set title:
     title = "Your Work Packages"
     #Set table column names:
     colnames=[s.replace("_"," ").title() for s in accessible_wps.columns.values[1:]]
-    return render_template('list.html',title=title,colnames=colnames,summaryLink="wp-summary",data=accessible_wps)
+    return stream_template('list.html',title=title,colnames=colnames,summaryLink="wp-summary",rows=accessible_wps.itertuples(index=False,name=None))
 
 #Partner list for partner leaders
 @app.route('/partner-list')
 @is_logged_in
 def partner_list():
     #Retrieve all partners:
-    all_partners = psql_to_pandas(Partners.query.order_by(Partners.id))
+    all_partners = psql_to_pandas(Partners.query.filter_by(project_id=g.project.id).order_by(Partners.id))
+    del all_partners['project_id'], all_partners['version']
     #Select only the accessible partners for this user:
     if session['username'] == 'admin':
         accessible_partners = all_partners
     else:
-        user_partners = psql_to_pandas(Users2Partners.query.filter_by(username=session['username']))['partner'].tolist()
+        user_partners = userPartners(session['username'])
         accessible_partners = all_partners[all_partners.name.isin(user_partners)]
     #Set title:
     title = "Your Partners"
     #Set table column names:
     colnames=[s.replace("_"," ").title() for s in accessible_partners.columns.values[1:]]
-    return render_template('list.html',title=title,colnames=colnames,summaryLink="partner-summary",data=accessible_partners)
+    return stream_template('list.html',title=title,colnames=colnames,summaryLink="partner-summary",rows=accessible_partners.itertuples(index=False,name=None))
 
 #WP summary for WP leaders
-@app.route('/wp-summary/<string:id>')
+@app.route('/wp-summary/<int:id>')
 @is_logged_in
 def wp_summary(id):
     #Retrieve DB entry:
-    db_row = Work_Packages.query.filter_by(id=id).first()
+    db_row = get_row(Work_Packages,id,g.project.id)
     if db_row is None:
         abort(404)
     wp_code = db_row.code
     wp_name = db_row.name
     #Check user has access to this wp:
     if not session['username'] == 'admin':
-        user_wps = psql_to_pandas(Users2Work_Packages.query.filter_by(username=session['username']))['work_package'].tolist()
+        user_wps = userWPs(session['username'])
         if wp_code not in user_wps:
             abort(403)
     #Retrieve all deliverables belonging to this work package:
-    delivData = psql_to_pandas(Deliverables.query.filter_by(work_package=wp_code).order_by(Deliverables.id))
-    del delivData['work_package']
-    delivData.fillna(value="", inplace=True)
-    delivColnames=[s.replace("_"," ").title() for s in delivData.columns.values[1:]]
-    #Retrieve all tasks belonging to this work package:
-    tasks = tasksPerWP(wp_code)
-    taskData = psql_to_pandas(Tasks.query.filter(Tasks.code.in_(tasks)).order_by(Tasks.id))
-    taskData.fillna(value="", inplace=True)
-    taskColnames=[s.replace("_"," ").title() for s in taskData.columns.values[1:]]
+    statement, params = work_package_deliverables(g.project.id,wp_code)
+    delivColumns, delivRows = psql_rows(statement,drop=['project_id','version','work_package'],params=params)
+    delivColnames=[s.replace("_"," ").title() for s in delivColumns[1:]]
+    #Retrieve all tasks belonging to this work package (via task_work_packages, see closure.py):
+    tasks = Tasks.query.filter_by(project_id=g.project.id).join(Task_Work_Packages,
+        (Task_Work_Packages.project_id==Tasks.project_id)&(Task_Work_Packages.task==Tasks.code)).filter(Task_Work_Packages.work_package==wp_code)
+    taskColumns, taskRows = psql_rows(tasks.order_by(Tasks.id),drop=['project_id','version'])
+    taskColnames=[s.replace("_"," ").title() for s in taskColumns[1:]]
     #Set title:
     title = "Summary for Work Package "+wp_code+" ("+wp_name+")"
-    return render_template('dt-view.html',title=title,delivData=delivData,delivColnames=delivColnames,taskData=taskData,taskColnames=taskColnames)
+    return stream_template('dt-view.html',title=title,delivRows=delivRows,delivColnames=delivColnames,taskRows=taskRows,taskColnames=taskColnames)
 
 #Partner summary for partner leaders
-@app.route('/partner-summary/<string:id>')
+@app.route('/partner-summary/<int:id>')
 @is_logged_in
 def partner_summary(id):
     #Retrieve DB entry:
-    db_row = Partners.query.filter_by(id=id).first()
+    db_row = get_row(Partners,id,g.project.id)
     if db_row is None:
         abort(404)
     #Check user has access to this partner:
     if not session['username'] == 'admin':
         partner_name = db_row.name
-        user_partners = psql_to_pandas(Users2Partners.query.filter_by(username=session['username']))['partner'].tolist()
+        user_partners = userPartners(session['username'])
         if partner_name not in user_partners:
             abort(403)
     #Retrieve all deliverables belonging to this partner:
-    delivData = psql_to_pandas(Deliverables.query.filter_by(responsible_partner=db_row.name).order_by(Deliverables.id))
-    del delivData['responsible_partner']
-    delivData.fillna(value="", inplace=True)
-    delivColnames=[s.replace("_"," ").title() for s in delivData.columns.values[1:]]
+    delivColumns, delivRows = psql_rows(Deliverables.query.filter_by(project_id=g.project.id,responsible_partner=db_row.name).order_by(Deliverables.id),drop=['project_id','version','responsible_partner'])
+    delivColnames=[s.replace("_"," ").title() for s in delivColumns[1:]]
     #Retrieve all tasks belonging to this partner:
-    taskData = psql_to_pandas(Tasks.query.filter_by(responsible_partner=db_row.name).order_by(Tasks.id))
-    del taskData['responsible_partner']
-    taskData.fillna(value="", inplace=True)
-    taskColnames=[s.replace("_"," ").title() for s in taskData.columns.values[1:]]
+    taskColumns, taskRows = psql_rows(Tasks.query.filter_by(project_id=g.project.id,responsible_partner=db_row.name).order_by(Tasks.id),drop=['project_id','version','responsible_partner'])
+    taskColnames=[s.replace("_"," ").title() for s in taskColumns[1:]]
     #Set title:
     title = "Summary for Partner '"+db_row.name+"'"
-    return render_template('dt-view.html',title=title,delivData=delivData,delivColnames=delivColnames,taskData=taskData,taskColnames=taskColnames)
+    return stream_template('dt-view.html',title=title,delivRows=delivRows,delivColnames=delivColnames,taskRows=taskRows,taskColnames=taskColnames)
 
 #Edit deliverable as non-admin
-@app.route('/deliv-edit/<string:id>', methods=['GET','POST'])
+@app.route('/deliv-edit/<int:id>', methods=['GET','POST'])
 @is_logged_in
 def deliv_edit(id):
     #Retrieve DB entry:
-    db_row = Deliverables.query.filter_by(id=id).first()
+    db_row = get_row(Deliverables,id,g.project.id)
     if db_row is None:
         abort(404)
     wp_code = db_row.work_package
     partner = db_row.responsible_partner
     #Check user has access to this deliverable:
     if not session['username'] == 'admin':
-        user_wps = psql_to_pandas(Users2Work_Packages.query.filter_by(username=session['username']))['work_package'].tolist()
-        user_partners = psql_to_pandas(Users2Partners.query.filter_by(username=session['username']))['partner'].tolist()
+        user_wps = userWPs(session['username'])
+        user_partners = userPartners(session['username'])
         if (wp_code not in user_wps) and (partner not in user_partners):
             abort(403)
     #Get form:
@@ -435,9 +718,8 @@ def deliv_edit(id):
     #If user submits edit entry form:
     if request.method == 'POST' and form.validate():
         #Get each form field and update DB:
-        for field in form:
-            exec("db_row."+field.name+" = field.data")
-        db.session.commit()
+        if not psql_update(db_row,form):
+            return merge_view(db_row,form,"Edit Deliverable",request.path,5)
         #Return with success:
         flash('Edits successful', 'success')
         return redirect(url_for('index'))
@@ -447,23 +729,24 @@ def deliv_edit(id):
             field.render_kw = {'readonly': 'readonly'}
         if not request.method == 'POST':
              exec("field.data = db_row."+field.name)
-    return render_template('alt-edit.html',id=id,form=form,title="Edit Deliverable",editLink="deliv-edit")
+    version = request.form.get('version',db_row.version) #Keep the loaded version if the form is redisplayed
+    return render_template('alt-edit.html',id=id,form=form,title="Edit Deliverable",editLink="deliv-edit",version=version)
 
 #Edit task as non-admin
-@app.route('/task-edit/<string:id>', methods=['GET','POST'])
+@app.route('/task-edit/<int:id>', methods=['GET','POST'])
 @is_logged_in
 def task_edit(id):
     #Retrieve DB entry:
-    db_row = Tasks.query.filter_by(id=id).first()
+    db_row = get_row(Tasks,id,g.project.id)
     if db_row is None:
         abort(404)
     task_code = db_row.code
     partner_name = db_row.responsible_partner
     #Check user has access to this task:
     if not session['username'] == 'admin':
-        user_partners = psql_to_pandas(Users2Partners.query.filter_by(username=session['username']))['partner'].tolist()
-        WPs = WPsPerTask(task_code)
-        user_wps = psql_to_pandas(Users2Work_Packages.query.filter_by(username=session['username']))['work_package'].tolist()
+        user_partners = userPartners(session['username'])
+        WPs = task_work_packages(g.project.id,task_code)
+        user_wps = userWPs(session['username'])
         if (partner_name not in user_partners) and (not any([x in user_wps for x in WPs])):
             abort(403)
     #Get form:
@@ -471,9 +754,8 @@ def task_edit(id):
     #If user submits edit entry form:
     if request.method == 'POST' and form.validate():
         #Get each form field and update DB:
-        for field in form:
-            exec("db_row."+field.name+" = field.data")
-        db.session.commit()
+        if not psql_update(db_row,form):
+            return merge_view(db_row,form,"Edit Task",request.path,4)
         flash('Edits successful', 'success')
         return redirect(url_for('index'))
     #Pre-populate form fields with existing data:
@@ -482,22 +764,23 @@ def task_edit(id):
             field.render_kw = {'readonly': 'readonly'}
         if not request.method == 'POST':
              exec("field.data = db_row."+field.name)
-    return render_template('alt-edit.html',id=id,form=form,title="Edit Task",editLink="task-edit")
+    version = request.form.get('version',db_row.version) #Keep the loaded version if the form is redisplayed
+    return render_template('alt-edit.html',id=id,form=form,title="Edit Task",editLink="task-edit",version=version)
 
 #Access settings for a given user
-@app.route('/access/<string:id>', methods=['GET','POST'])
+@app.route('/access/<int:id>', methods=['GET','POST'])
 @is_logged_in_as_admin
 def access(id):
     form = AccessForm(request.form)
     form.work_packages.choices = table_list('Work_Packages','code')[1:]
     form.partners.choices = table_list('Partners','name')[1:]
     #Retrieve user DB entry:
-    user = Users.query.filter_by(id=id).first()
+    user = get_row(Users,id)
     if user is None:
         abort(404)
-    #Retrieve all relevant entries in users2work_packages and users2partners:
-    current_work_packages = psql_to_pandas(Users2Work_Packages.query.filter_by(username=user.username))['work_package'].tolist()
-    current_partners = psql_to_pandas(Users2Partners.query.filter_by(username=user.username))['partner'].tolist()
+    #Retrieve all relevant entries in users2work_packages and users2partners (in the active project):
+    current_work_packages = userWPs(user.username)
+    current_partners = userPartners(user.username)
     #If user submits edit entry form:
     if request.method == 'POST' and form.validate():
         new_work_packages = form.work_packages.data
@@ -505,22 +788,22 @@ def access(id):
         #Delete relevant rows from users2work_packages:
         wps_to_delete = list(set(current_work_packages)-set(new_work_packages))
         for wp in wps_to_delete:
-            db_row = Users2Work_Packages.query.filter_by(username=user.username,work_package=wp).first()
+            db_row = Users2Work_Packages.query.filter_by(project_id=g.project.id,username=user.username,work_package=wp).first()
             psql_delete(db_row,flashMsg=False)
         #Add relevant rows to users2work_packages:
         wps_to_add = list(set(new_work_packages)-set(current_work_packages))
         for wp in wps_to_add:
-            db_row = Users2Work_Packages(username=user.username,work_package=wp)
+            db_row = Users2Work_Packages(username=user.username,work_package=wp,project_id=g.project.id)
             psql_insert(db_row,flashMsg=False)
         #Delete relevant rows from users2partners:
         partners_to_delete = list(set(current_partners)-set(new_partners))
         for partner in partners_to_delete:
-            db_row = Users2Partners.query.filter_by(username=user.username,partner=partner).first()
+            db_row = Users2Partners.query.filter_by(project_id=g.project.id,username=user.username,partner=partner).first()
             psql_delete(db_row,flashMsg=False)
         #Add relevant rows to users2work_packages:
         partners_to_add = list(set(new_partners)-set(current_partners))
         for partner in partners_to_add:
-            db_row = Users2Partners(username=user.username,partner=partner)
+            db_row = Users2Partners(username=user.username,partner=partner,project_id=g.project.id)
             psql_insert(db_row,flashMsg=False)
         #Return with success
         flash('Edits successful', 'success')
@@ -532,6 +815,129 @@ def access(id):
     form.partners.data = current_partners
     return render_template('access.html',form=form,id=id)
 
+#Work packages and partners that a non-admin user's timeline and burn-up charts are limited
+#to (None for admin):
+def item_access():
+    if session['username'] == 'admin':
+        return None
+    return userWPs(session['username']), userPartners(session['username'])
+
+#Burn-up charts
+@app.route('/burnup')
+@is_logged_in
+def burnup():
+    return render_template('burnup.html',title="Burn-up Charts")
+
+#Burn-up curve data (per WP or per partner)
+@app.route('/burnup-data/<string:group>')
+@is_logged_in
+def burnup_data(group):
+    if group not in ['wp', 'partner']:
+        abort(404)
+    return jsonify(burnup_curves(g.project,group,item_access()))
+
+#Timeline of deliverables and tasks due per project month (per WP or per partner)
+@app.route('/timeline/<string:group>')
+@is_logged_in
+def timeline_view(group):
+    if group not in ['wp', 'partner']:
+        abort(404)
+    title = "Timeline by "+("Work Package" if group=='wp' else "Partner")
+    return render_template('timeline.html',title=title,group=group,month=currentMonth(),**timeline(g.project,group,item_access()))
+
+#Deliverables and tasks due in one project month (optionally in one WP or partner), a page at a time
+@app.route('/timeline-items/<string:group>/<int:month>')
+@is_logged_in
+def timeline_items_view(group,month):
+    if group not in ['wp', 'partner']:
+        abort(404)
+    name = request.args.get('name')
+    page = max(request.args.get('page',1,type=int),1)
+    items, more = timeline_items(g.project,group,month,name,page,app.config['TIMELINE_PAGE_SIZE'],item_access())
+    title = "Due in project month "+str(month)+(" ("+name+")" if name else "")
+    return render_template('timeline-items.html',title=title,group=group,month=month,name=name,page=page,items=items,more=more)
+
+#Switch the active project
+@app.route('/project/<int:id>')
+@is_logged_in
+def switch_project(id):
+    project = get_row(Projects,id)
+    if project is None:
+        abort(404)
+    session['project_id'] = project.id
+    flash('Now viewing project '+project.name, 'success')
+    return redirect(url_for('index'))
+
+#At-risk deliverables and work packages (visible to admin, or filtered to the user's WPs/partners)
+def accessible_risk():
+    delivRisk, wpRisk, month = at_risk(g.project)
+    if not session['username'] == 'admin':
+        user_wps = userWPs(session['username'])
+        user_partners = userPartners(session['username'])
+        delivRisk = delivRisk[delivRisk.work_package.isin(user_wps) | delivRisk.responsible_partner.isin(user_partners)]
+        wpRisk = wpRisk[wpRisk.code.isin(user_wps)]
+    return delivRisk[delivRisk.at_risk], wpRisk[wpRisk.at_risk], month
+
+#At-risk page
+@app.route('/at-risk')
+@is_logged_in
+def at_risk_view():
+    delivRisk, wpRisk, month = accessible_risk()
+    title = "At Risk (project month "+str(month)+")"
+    return render_template('at-risk.html',title=title,delivData=delivRisk,wpData=wpRisk)
+
+#At-risk data as JSON
+@app.route('/at-risk-data')
+@is_logged_in
+def at_risk_data():
+    delivRisk, wpRisk, month = accessible_risk()
+    return jsonify({'month': month,
+                    'deliverables': json.loads(delivRisk.drop('at_risk',axis=1).to_json(orient='records')),
+                    'work_packages': json.loads(wpRisk.drop('at_risk',axis=1).to_json(orient='records'))})
+
+#Queue reports and list them for download (they are built by: python manage.py worker)
+@app.route('/reports', methods=['GET','POST'])
+@is_logged_in_as_admin
+def reports_view():
+    form = ReportForm(request.form)
+    form.file_format.choices = report_formats()
+    form.scope.choices = [('portfolio','Whole portfolio (all projects)'),('project','Project '+g.project.code+' (all partners)')] \
+        + [('partner:'+name,'Partner '+name+' ('+g.project.code+')') for name,label in table_list('Partners','name')[1:]]
+    #If user queues a report:
+    if request.method == 'POST' and form.validate():
+        if form.scope.data == 'portfolio':
+            queue_report(form.file_format.data,session['username'])
+        elif form.scope.data == 'project':
+            queue_report(form.file_format.data,session['username'],projectId=g.project.id)
+        else:
+            queue_report(form.file_format.data,session['username'],projectId=g.project.id,partner=form.scope.data[len('partner:'):])
+        flash('Report queued', 'success')
+        return redirect(url_for('reports_view'))
+    jobs = recent_jobs()
+    projectCodes = dict((project.id,project.code) for project in Projects.query)
+    pending = any(job.status in ('queued','running') for job in jobs)
+    return render_template('reports.html',title="Reports",form=form,jobs=jobs,projectCodes=projectCodes,pending=pending)
+
+#Report status as JSON (for polling)
+@app.route('/report-status/<int:id>')
+@is_logged_in_as_admin
+def report_status(id):
+    job = get_row(Report_Jobs,id)
+    if job is None:
+        abort(404)
+    return jsonify({'status': job.status, 'filename': job.filename, 'size': job.size, 'error': job.error,
+                    'download': url_for('report_download',id=job.id) if job.status == 'done' else None})
+
+#Download a built report (streamed from the database a chunk at a time)
+@app.route('/report-download/<int:id>')
+@is_logged_in_as_admin
+def report_download(id):
+    job = get_row(Report_Jobs,id)
+    if job is None or job.status != 'done':
+        abort(404)
+    headers = {'Content-Disposition': 'attachment; filename="'+job.filename+'"', 'Content-Length': str(job.size)}
+    return Response(stream_with_context(report_chunks(job.id)),mimetype=contentTypes[job.file_format],headers=headers)
+
 #Login
 @app.route('/login', methods=["GET","POST"])
 def login():
@@ -552,10 +958,10 @@ def login():
                 flash('Incorrect password', 'danger')
                 return redirect(url_for('login'))
         #Check user accounts:
-        user = Users.query.filter_by(username=username).first()
+        user = user_by_username(username)
         if user is not None:
             password = user.password
-            if sha256_crypt.verify(password_candidate, password):
+            if offload(sha256_crypt.verify,password_candidate,password):
                 session['logged_in'] = True
                 session['username'] = username
                 flash('You are now logged in', 'success')
@@ -587,11 +993,11 @@ def logout():
 def change_pwd():
     form = ChangePwdForm(request.form)
     if request.method == 'POST' and form.validate():
-        user = Users.query.filter_by(username=session['username']).first()
+        user = user_by_username(session['username'])
         password = user.password
         current = form.current.data
-        if sha256_crypt.verify(current, password):
-            user.password = sha256_crypt.encrypt(str(form.new.data))
+        if offload(sha256_crypt.verify,current,password):
+            user.password = offload(sha256_crypt.encrypt,str(form.new.data))
             db.session.commit()
             flash('Password changed', 'success')
             return redirect(url_for('change_pwd'))
@@ -0,0 +1,79 @@
+"""
+Dependency-graph analytics over the task->deliverable->work package graph.
+
+The tasks2deliverables links of a project are loaded once into integer index arrays (CSR-style adjacency,
+grouped by deliverable) and every deliverable and work package is scored in one vectorised
+pass. A task is late if its month_due has passed and it is not 100% complete. Results are
+cached per process and project, and cleared whenever a commit changes the project (its months),
+tasks, deliverables, work packages or their links (see caching.py).
+"""
+
+import numpy as np
+import pandas as pd
+
+from SWIFTDBApp import psql_to_pandas, currentMonth
+from models import Projects, Work_Packages, Deliverables, Tasks, Tasks2Deliverables
+from caching import ProjectCache, primary
+
+_cache = ProjectCache([Projects, Work_Packages, Deliverables, Tasks, Tasks2Deliverables]) #(project id,) -> (deliverable risk, WP risk, project month)
+
+def load_graph(project_id):
+    tasks = psql_to_pandas(Tasks.query.filter_by(project_id=project_id)
+        .with_entities(Tasks.code,Tasks.month_due,Tasks.percent).order_by(Tasks.id),primary())
+    delivs = psql_to_pandas(Deliverables.query.filter_by(project_id=project_id)
+        .with_entities(Deliverables.code,Deliverables.work_package,Deliverables.responsible_partner,
+        Deliverables.month_due,Deliverables.percent).order_by(Deliverables.id),primary())
+    wps = psql_to_pandas(Work_Packages.query.filter_by(project_id=project_id)
+        .with_entities(Work_Packages.code,Work_Packages.name).order_by(Work_Packages.id),primary())
+    links = psql_to_pandas(Tasks2Deliverables.query.filter_by(project_id=project_id)
+        .with_entities(Tasks2Deliverables.task,Tasks2Deliverables.deliverable),primary())
+    #Integer ids for every node and edge:
+    linkTask = pd.Index(tasks['code']).get_indexer(links['task'])
+    linkDeliv = pd.Index(delivs['code']).get_indexer(links['deliverable'])
+    delivWP = pd.Index(wps['code']).get_indexer(delivs['work_package'])
+    #Deliverable -> tasks adjacency (tasks of deliverable d are taskIdx[indptr[d]:indptr[d+1]]):
+    order = np.argsort(linkDeliv, kind='mergesort')
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(linkDeliv, minlength=len(delivs)))])
+    #Distinct (task, WP) pairs, so a task linked to two deliverables of one WP counts once:
+    pairKey = np.unique(delivWP[linkDeliv].astype(np.int64)*len(tasks) + linkTask)
+    return {'tasks': tasks, 'delivs': delivs, 'wps': wps,
+            'linkTask': linkTask, 'linkDeliv': linkDeliv, 'delivWP': delivWP,
+            'indptr': indptr, 'taskIdx': linkTask[order],
+            'pairWP': pairKey // max(len(tasks),1), 'pairTask': pairKey % max(len(tasks),1)}
+
+def compute_risk(graph, month):
+    tasks, delivs, wps = graph['tasks'], graph['delivs'], graph['wps']
+    taskDue = tasks['month_due'].values
+    late = (taskDue < month) & (tasks['percent'].values < 100)
+    #Per deliverable: number of late upstream tasks and latest upstream task due date:
+    linkTask, linkDeliv = graph['linkTask'], graph['linkDeliv']
+    delivLate = np.bincount(linkDeliv, weights=late[linkTask], minlength=len(delivs)).astype(int)
+    delivLatest = np.full(len(delivs), -1)
+    np.maximum.at(delivLatest, linkDeliv, taskDue[linkTask])
+    delivRisk = delivs.copy()
+    delivRisk['late_tasks'] = delivLate
+    delivRisk['latest_task_due'] = delivLatest
+    delivRisk['at_risk'] = (delivLate > 0) | (delivLatest > delivs['month_due'].values)
+    taskCodes = tasks['code'].values
+    delivRisk['late_task_codes'] = [', '.join(taskCodes[idx[late[idx]]])
+        for idx in np.split(graph['taskIdx'], graph['indptr'][1:-1])] if len(delivs) else [] #(split gives one piece even with no deliverables)
+    #Per work package, over distinct upstream tasks:
+    pairWP, pairTask = graph['pairWP'], graph['pairTask']
+    wpLate = np.bincount(pairWP, weights=late[pairTask], minlength=len(wps)).astype(int)
+    wpLatest = np.full(len(wps), -1)
+    np.maximum.at(wpLatest, pairWP, taskDue[pairTask])
+    wpRisk = wps.copy()
+    wpRisk['late_tasks'] = wpLate
+    wpRisk['latest_task_due'] = wpLatest
+    wpRisk['at_risk_deliverables'] = np.bincount(graph['delivWP'], weights=delivRisk['at_risk'].values,
+        minlength=len(wps)).astype(int)
+    wpRisk['at_risk'] = (wpLate > 0) | (wpRisk['at_risk_deliverables'].values > 0)
+    return delivRisk, wpRisk
+
+def project_risk(project):
+    month = currentMonth(project)
+    return compute_risk(load_graph(project.id), month) + (month,)
+
+def at_risk(project):
+    #Cached (deliverable risk, WP risk, project month):
+    return _cache.get((project.id,), lambda: project_risk(project))
@@ -0,0 +1,106 @@
+"""
+Static asset fingerprinting and compression.
+
+Build step: copy every file in static/ to static/dist/ under a name containing a hash of its
+contents (e.g. NCAS-logo.3f2a9c1b7e40.jpg), with gzip (and brotli, if the brotli package is
+installed) precompressed copies of compressible files, and write static/dist/manifest.json
+mapping the original names to the fingerprinted ones:
+$ python assets.py
+(run automatically on Heroku by bin/post_compile). url_for('static', filename=...) in the
+templates then gives the fingerprinted names, which are served with far-future immutable
+cache headers, since their contents can never change. Without a build, the original files
+are served as before.
+
+Also provides the streaming gzip/brotli compressors used to compress HTML and JSON responses.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+staticDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+distName = 'dist'
+compressible = ('.ico', '.css', '.js', '.svg', '.txt', '.json', '.html')
+
+########## BUILD ##########
+def build(staticDir=staticDir):
+    distDir = os.path.join(staticDir, distName)
+    if os.path.isdir(distDir):
+        shutil.rmtree(distDir)
+    os.makedirs(distDir)
+    manifest = {}
+    for name in sorted(os.listdir(staticDir)):
+        path = os.path.join(staticDir, name)
+        if not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            data = f.read()
+        stem, ext = os.path.splitext(name)
+        hashedName = stem+'.'+hashlib.md5(data).hexdigest()[:12]+ext
+        hashedPath = os.path.join(distDir, hashedName)
+        shutil.copyfile(path, hashedPath)
+        #Precompressed copies, where compression helps:
+        if ext.lower() in compressible:
+            write_if_smaller(hashedPath+'.gz', gzip.compress(data, 9), data)
+            if brotli is not None:
+                write_if_smaller(hashedPath+'.br', brotli.compress(data, quality=11), data)
+        manifest[name] = distName+'/'+hashedName
+    with open(os.path.join(distDir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+def write_if_smaller(path, compressed, data):
+    if len(compressed) < 0.9*len(data):
+        with open(path, 'wb') as f:
+            f.write(compressed)
+
+def load_manifest(staticDir=staticDir):
+    #Original name -> fingerprinted name (empty if the build step hasn't been run):
+    path = os.path.join(staticDir, distName, 'manifest.json')
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+###########################
+
+########## COMPRESSION ##########
+def choose_encoding(accept_encodings):
+    #Best encoding accepted by the client (werkzeug Accept object), or None:
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, 6)
+
+def compress_stream(chunks, encoding):
+    #Compress an iterator of byte strings, flushing after each chunk so that the browser can
+    #start rendering before the response is complete:
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=5)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) #31: gzip format
+        process, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+    for chunk in chunks:
+        data = process(chunk) + flush()
+        if data:
+            yield data
+    yield finish()
+#################################
+
+if __name__ == '__main__':
+    manifest = build()
+    print("Fingerprinted "+str(len(manifest))+" static files into static/"+distName+(" (brotli not installed)" if brotli is None else ""))
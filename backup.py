@@ -0,0 +1,208 @@
+"""
+Consistent backup and restore of the whole database (all projects and users).
+
+Backup dumps every table under a single snapshot (one REPEATABLE READ transaction on
+PostgreSQL, one read transaction on SQLite), so the files are consistent with each other even
+if edits are made during the backup. Tables are written one at a time via temporary files
+into a single .tar.gz archive, so memory use doesn't grow with the size of the database:
+$ python manage.py backup -f swiftdb-backup.tar.gz
+
+Restore replaces the contents of every table with those in an archive, in one transaction,
+loading tables in foreign key order (PostgreSQL COPY, or batched inserts on SQLite), and then
+resets the id sequences and rebuilds the derived task_work_packages table:
+$ python manage.py restore -f swiftdb-backup.tar.gz
+
+The archive holds one CSV file per table in PostgreSQL's COPY format (NULL written as \\N,
+every other value quoted, arrays as {1,2,3}), so a backup of the production database on Heroku can be
+restored into a local PostgreSQL or SQLite database, e.g.
+$ heroku run python manage.py backup -f /tmp/prod.tar.gz
+The schema must be at the same migration revision in both databases.
+"""
+
+import codecs
+import csv
+import datetime as dt
+import io
+import json
+import sqlite3
+import tarfile
+import tempfile
+from sqlalchemy.dialects import postgresql
+
+from SWIFTDBApp import db
+from closure import rebuild_task_work_packages
+
+batchSize = 5000 #Rows per insert when restoring into SQLite
+nullMarker = '\\N' #How NULL is written in the CSV files
+reportTables = ['report_chunks', 'report_jobs'] #Built reports (see reports.py) are not backed up, and are cleared by a restore
+
+def is_array(column):
+    #Array columns (stored as JSON lists on SQLite):
+    return isinstance(column.type, postgresql.ARRAY) or isinstance(getattr(column.type,'impl',None), postgresql.ARRAY)
+
+def schema_revision(cursor):
+    #Current alembic migration revision, if the database was created by migrations:
+    if db.engine.dialect.name == 'sqlite':
+        cursor.execute("SELECT count(*) FROM sqlite_master WHERE name = 'alembic_version'")
+    else:
+        cursor.execute("SELECT count(*) FROM pg_tables WHERE tablename = 'alembic_version' AND schemaname = current_schema()")
+    if not cursor.fetchone()[0]:
+        return None
+    cursor.execute('SELECT version_num FROM alembic_version')
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def add_file(tar, name, fileobj):
+    info = tarfile.TarInfo(name)
+    info.size = fileobj.seek(0, io.SEEK_END)
+    info.mtime = int(dt.datetime.now().timestamp())
+    fileobj.seek(0)
+    tar.addfile(info, fileobj)
+
+########## BACKUP ##########
+def backup(path):
+    tables = [table for table in db.metadata.sorted_tables if table.name not in reportTables] #Parents before children
+    rowCounts = {}
+    with tarfile.open(path, 'w:gz') as tar:
+        if db.engine.dialect.name == 'sqlite':
+            conn = sqlite3.connect(db.engine.url.database, isolation_level=None)
+            cursor = conn.cursor()
+            cursor.execute('BEGIN') #All reads below see the same snapshot
+            dump = lambda table, f: dump_sqlite(cursor, table, f)
+        else:
+            conn = db.engine.raw_connection()
+            cursor = conn.cursor()
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+            dump = lambda table, f: dump_postgres(cursor, table, f)
+        try:
+            revision = schema_revision(cursor)
+            manifest = {'created': dt.datetime.now().isoformat(), 'dialect': db.engine.dialect.name,
+                        'revision': revision, 'tables': [table.name for table in tables]}
+            add_file(tar, 'manifest.json', io.BytesIO(json.dumps(manifest, indent=2).encode('utf-8')))
+            for table in tables:
+                with tempfile.TemporaryFile() as f:
+                    rowCounts[table.name] = dump(table, f)
+                    add_file(tar, table.name+'.csv', f)
+        finally:
+            conn.rollback()
+            conn.close()
+    return rowCounts
+
+def dump_postgres(cursor, table, f):
+    cols = ', '.join('"'+c.name+'"' for c in table.columns)
+    cursor.copy_expert("COPY (SELECT "+cols+" FROM \""+table.name+"\" ORDER BY id) TO STDOUT WITH CSV HEADER NULL '"+nullMarker+"' FORCE QUOTE *", f)
+    return cursor.rowcount
+
+def dump_sqlite(cursor, table, f):
+    #Write the same format as PostgreSQL's COPY ... CSV NULL '\N' FORCE QUOTE *:
+    columns = list(table.columns)
+    text = io.TextIOWrapper(f, encoding='utf-8', newline='')
+    text.write(','.join(c.name for c in columns)+'\n')
+    cursor.execute('SELECT '+', '.join('"'+c.name+'"' for c in columns)+' FROM "'+table.name+'" ORDER BY id')
+    nRows = 0
+    while True:
+        rows = cursor.fetchmany(batchSize)
+        if not rows:
+            break
+        for row in rows:
+            fields = []
+            for column, value in zip(columns, row):
+                if value is None:
+                    fields.append(nullMarker)
+                    continue
+                if is_array(column):
+                    value = '{'+','.join(str(v) for v in json.loads(value))+'}'
+                fields.append('"'+str(value).replace('"','""')+'"')
+            text.write(','.join(fields)+'\n')
+        nRows += len(rows)
+    text.flush()
+    text.detach()
+    return nRows
+############################
+
+########## RESTORE ##########
+def restore(path):
+    tables = dict((table.name, table) for table in db.metadata.sorted_tables)
+    rowCounts = {}
+    if db.engine.dialect.name == 'sqlite':
+        conn = sqlite3.connect(db.engine.url.database, isolation_level=None, timeout=30)
+        conn.execute('PRAGMA foreign_keys=ON')
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        load = lambda table, f: load_sqlite(cursor, table, f)
+    else:
+        conn = db.engine.raw_connection()
+        cursor = conn.cursor()
+        load = lambda table, f: load_postgres(cursor, table, f)
+    try:
+        #Read the archive as a stream (tables are stored in foreign key order):
+        with tarfile.open(path, 'r|gz') as tar:
+            for member in tar:
+                f = tar.extractfile(member)
+                if member.name == 'manifest.json':
+                    manifest = json.loads(f.read().decode('utf-8'))
+                    check_manifest(manifest, tables, schema_revision(cursor))
+                    #Empty every table (children first) before loading:
+                    emptied = reportTables + list(reversed(manifest['tables']))
+                    if db.engine.dialect.name == 'sqlite':
+                        for name in emptied:
+                            cursor.execute('DELETE FROM "'+name+'"')
+                    else:
+                        cursor.execute('TRUNCATE '+', '.join('"'+name+'"' for name in emptied))
+                    continue
+                name = member.name[:-len('.csv')]
+                rowCounts[name] = load(tables[name], f)
+        if db.engine.dialect.name == 'sqlite':
+            cursor.execute('COMMIT')
+        else:
+            reset_sequences(cursor, [tables[name] for name in rowCounts])
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    rebuild_task_work_packages()
+    return rowCounts
+
+def check_manifest(manifest, tables, revision):
+    if manifest['revision'] != revision:
+        raise ValueError('Backup is of schema revision '+str(manifest['revision'])+' but the database is at revision '
+                         +str(revision)+' (run: python manage.py db upgrade)')
+    unknown = [name for name in manifest['tables'] if name not in tables]
+    if unknown:
+        raise ValueError('Backup contains unknown tables: '+', '.join(unknown))
+
+def load_postgres(cursor, table, f):
+    header = f.readline().decode('utf-8').strip()
+    cursor.copy_expert("COPY \""+table.name+"\" ("+header+") FROM STDIN WITH CSV NULL '"+nullMarker+"'", f)
+    return cursor.rowcount
+
+def load_sqlite(cursor, table, f):
+    reader = csv.reader(codecs.iterdecode(f, 'utf-8'))
+    names = next(reader)
+    columns = [table.columns[name] for name in names]
+    #Arrays are stored as JSON:
+    def convert(column, value):
+        if value == nullMarker:
+            return None
+        if is_array(column):
+            return '['+value.strip('{}')+']'
+        return value
+    insert = 'INSERT INTO "'+table.name+'" ('+', '.join('"'+n+'"' for n in names)+') VALUES ('+', '.join('?'*len(names))+')'
+    nRows = 0
+    batch = []
+    for row in reader:
+        batch.append([convert(column, value) for column, value in zip(columns, row)])
+        if len(batch) == batchSize:
+            cursor.executemany(insert, batch)
+            nRows += len(batch)
+            batch = []
+    cursor.executemany(insert, batch)
+    return nRows + len(batch)
+
+def reset_sequences(cursor, tables):
+    #Make new rows get ids after the restored ones:
+    for table in tables:
+        cursor.execute("SELECT setval(pg_get_serial_sequence('"+table.name+"', 'id'), COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) FROM \""+table.name+'"')
+#############################
@@ -0,0 +1,149 @@
+"""
+Bulk upload of .tab/.csv files into any table that the admin can add to via the web forms.
+
+The file is parsed as a stream and every row is validated in one pass with the table's
+existing WTForms form, with foreign keys (work packages, partners, tasks, deliverables)
+checked against in-memory sets of the codes in the active project. Valid rows are then
+written with a single bulk INSERT (or INSERT ... ON CONFLICT DO UPDATE when upserting) in
+one transaction. Passwords of uploaded users are only hashed then (not on a dry run), in a
+thread (see offload() in SWIFTDBApp.py).
+
+Columns are in the same order as the web form fields (as in the .tab files used by
+populatePSQL.py). A header row is optional: if the first row matches the form field names it
+is used to map the columns instead.
+"""
+
+import codecs
+import csv
+from werkzeug.datastructures import MultiDict
+from sqlalchemy.dialects import postgresql, sqlite
+from passlib.hash import sha256_crypt
+
+from SWIFTDBApp import db, offload
+from models import Partners, Work_Packages, Deliverables, Tasks
+from closure import refresh_task_work_packages
+
+uploadModes = ['insert', 'upsert']
+
+#Columns identifying an existing row in each table (within a project):
+uploadKeys = {'Projects': ['code'],
+              'Partners': ['name'],
+              'Work_Packages': ['code'],
+              'Deliverables': ['code'],
+              'Users': ['username'],
+              'Tasks': ['code'],
+              'Tasks2Deliverables': ['task', 'deliverable']}
+
+#Select fields that reference another table, and the column they must match:
+fkFields = {'work_package': (Work_Packages, 'code'),
+            'responsible_partner': (Partners, 'name'),
+            'task': (Tasks, 'code'),
+            'deliverable': (Deliverables, 'code')}
+
+def decode_lines(stream, badLines):
+    #Decode the file a line at a time, recording the numbers of lines that aren't valid UTF-8
+    #(which are replaced by blank lines, so that the line numbers stay right):
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    for n, data in enumerate(stream, 1):
+        try:
+            yield decoder.decode(data)
+        except UnicodeDecodeError:
+            decoder.reset()
+            badLines.append(n)
+            yield '\n'
+
+def read_rows(fileStorage):
+    #Stream-parse the uploaded file, yielding (line number, row), or (line number, None) for a
+    #line that isn't valid UTF-8:
+    delimiter = ',' if fileStorage.filename.lower().endswith('.csv') else '\t'
+    badLines = []
+    reader = csv.reader(decode_lines(fileStorage.stream, badLines), delimiter=delimiter)
+    for row in reader:
+        while badLines:
+            yield badLines.pop(0), None
+        if any(cell.strip() for cell in row):
+            yield reader.line_num, row
+
+def validate_rows(rows, tableClass, model, formClass, project_id, mode):
+    #Validate every row, returning (valid rows as column dicts, [(line, message)]):
+    form = formClass()
+    fieldNames = [field.name for field in form]
+    valid = {}
+    for field in form:
+        if field.name in fkFields:
+            fkModel, col = fkFields[field.name]
+            valid[field.name] = set(c for (c,) in db.session.query(getattr(fkModel,col)).filter_by(project_id=project_id))
+    keyCols = uploadKeys[tableClass]
+    existing = set()
+    if mode == 'insert':
+        query = db.session.query(*[getattr(model,c) for c in keyCols])
+        if 'project_id' in model.__table__.columns:
+            query = query.filter_by(project_id=project_id)
+        existing = set(tuple(key) for key in query)
+    seen = {}
+    good = []
+    errors = []
+    columns = fieldNames
+    for i, (line, row) in enumerate(rows):
+        if row is None:
+            errors.append((line, "Not valid UTF-8 text (save the file with UTF-8 encoding)"))
+            continue
+        if i == 0 and set(row) == set(fieldNames):
+            columns = row
+            continue
+        if len(row) != len(columns):
+            errors.append((line, "Expected "+str(len(columns))+" columns, found "+str(len(row))))
+            continue
+        form.process(MultiDict(zip(columns, row)))
+        #Only existing codes are valid choices for foreign key fields:
+        for name in valid:
+            field = getattr(form, name)
+            field.choices = [(field.data, field.data)] if field.data in valid[name] else []
+        if not form.validate():
+            for name, messages in form.errors.items():
+                for message in messages:
+                    errors.append((line, getattr(form,name).label.text.lstrip('*')+": "+message))
+            continue
+        key = tuple(getattr(form,c).data for c in keyCols)
+        if key in seen:
+            errors.append((line, "Duplicate of line "+str(seen[key])))
+            continue
+        if key in existing:
+            errors.append((line, "Already exists: "+", ".join(str(k) for k in key)))
+            continue
+        seen[key] = line
+        values = dict((field.name, field.data) for field in form)
+        if 'project_id' in model.__table__.columns:
+            values['project_id'] = project_id
+        good.append(values)
+    return good, errors
+
+def apply_rows(tableClass, model, values, mode):
+    #Bulk insert/upsert all valid rows in one transaction:
+    if not values:
+        return
+    if tableClass == 'Users':
+        for row in values:
+            row['password'] = offload(sha256_crypt.encrypt,str(row['password']))
+    table = model.__table__
+    if mode == 'upsert':
+        keyCols = uploadKeys[tableClass]
+        if 'project_id' in table.columns:
+            keyCols = ['project_id'] + keyCols
+        dialect = sqlite if db.engine.dialect.name == 'sqlite' else postgresql
+        stmt = dialect.insert(table)
+        updates = dict((c, stmt.excluded[c]) for c in values[0] if c not in keyCols)
+        if 'version' in table.columns:
+            updates['version'] = table.c.version + 1 #So that edit forms open before the upload go stale
+        stmt = stmt.on_conflict_do_update(index_elements=keyCols, set_=updates)
+    else:
+        stmt = table.insert()
+    try:
+        db.session.execute(stmt, values)
+        if tableClass in ('Deliverables', 'Tasks2Deliverables'):
+            #Bulk writes bypass the flush events that maintain task_work_packages:
+            refresh_task_work_packages(db.session.connection(), values[0]['project_id'])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
@@ -0,0 +1,77 @@
+"""
+Per-process caches of results computed from a project's data (the at-risk analytics, the
+timeline and the burn-up curves).
+
+A cache lists the models its results are computed from (including Projects, for results that
+depend on a project's months). When a transaction that added, changed or deleted rows of those
+models commits, the cached results of the projects concerned are cleared. Writes made outside
+the ORM within a transaction (e.g. to task_work_packages, see closure.py) are recorded with
+record_write(). Clearing on commit rather than on flush matters under gevent workers: between the
+flush and the commit, another request could recompute from the old data and cache it. For the
+same reason, a result is only stored if no commit cleared its project while it was being
+computed. Results are computed from the primary database (see primary()), since a read
+replica can lag behind just after a commit. Entries also expire after ANALYTICS_CACHE_SECONDS,
+so that other gunicorn workers, and writes made by other processes, are picked up too.
+"""
+
+import time
+from sqlalchemy import event
+
+from SWIFTDBApp import app, db
+from models import Projects
+
+_caches = []
+
+class ProjectCache(object):
+    def __init__(self, models):
+        self.models = tuple(models)
+        self.entries = {} #key, starting with the project id -> (time computed, result)
+        self.generations = {} #project id -> number of times cleared
+        _caches.append(self)
+
+    def get(self, key, compute):
+        cached = self.entries.get(key)
+        if cached is not None and time.time()-cached[0] <= app.config['ANALYTICS_CACHE_SECONDS']:
+            return cached[1]
+        generation = self.generations.get(key[0], 0)
+        result = compute()
+        if self.generations.get(key[0], 0) == generation: #Not cleared meanwhile
+            self.entries[key] = (time.time(), result)
+        return result
+
+    def invalidate(self, project_id):
+        self.generations[project_id] = self.generations.get(project_id, 0) + 1
+        for key in [key for key in self.entries if key[0] == project_id]:
+            self.entries.pop(key, None)
+
+def invalidate_caches(project_id):
+    #For writes that bypass the ORM (e.g. bulk upload):
+    for cache in _caches:
+        cache.invalidate(project_id)
+
+def primary():
+    #Engine for the queries behind cached results:
+    return db.engine
+
+def record_write(session, model, project_id):
+    #Clear the results computed from this model in a project once the session's transaction commits:
+    pending = session.info.setdefault('cache_invalidations', set())
+    for cache in _caches:
+        if issubclass(model, cache.models):
+            pending.add((cache, project_id))
+
+@event.listens_for(db.session, 'after_flush')
+def _record_writes(session, flush_context):
+    #Projects whose cached results this transaction changes (cleared once it commits):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if any(isinstance(obj, cache.models) for cache in _caches):
+            record_write(session, type(obj), obj.id if isinstance(obj, Projects) else obj.project_id)
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_on_commit(session):
+    for cache, project_id in session.info.pop('cache_invalidations', ()):
+        cache.invalidate(project_id)
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_writes(session):
+    session.info.pop('cache_invalidations', None)
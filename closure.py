@@ -0,0 +1,85 @@
+"""
+The task_work_packages table: which work packages each task belongs to (via the deliverables
+it is linked to in tasks2deliverables), stored so that access checks and work package task
+lists are single indexed lookups instead of walking the links every time.
+
+The table is kept up to date in the same transaction as the writes that change it: after each
+flush that adds, changes or deletes tasks2deliverables rows, or changes a deliverable's code or
+work package, the rows of the affected tasks are recomputed. Writes that bypass the ORM (bulk
+upload, restore, populatePSQL.py/.sh) refresh it for the whole project or database. It can be
+checked against the links, and rebuilt if they differ, using:
+$ python manage.py closure [--check-only]
+"""
+
+from sqlalchemy import event, select, inspect
+
+from SWIFTDBApp import db
+from models import Deliverables, Tasks2Deliverables, Task_Work_Packages
+from caching import record_write
+
+closure = Task_Work_Packages.__table__
+links = Tasks2Deliverables.__table__
+delivs = Deliverables.__table__
+
+def closure_select(projectId=None, tasks=None):
+    #Distinct (project, task, work package) rows implied by the links:
+    query = select(links.c.project_id, links.c.task, delivs.c.work_package).distinct() \
+        .select_from(links.join(delivs, (delivs.c.project_id == links.c.project_id) & (delivs.c.code == links.c.deliverable)))
+    if projectId is not None:
+        query = query.where(links.c.project_id == projectId)
+    if tasks is not None:
+        query = query.where(links.c.task.in_(tasks))
+    return query
+
+def refresh_task_work_packages(conn, projectId=None, tasks=None):
+    #Recompute the rows of the given tasks (or of a whole project, or of every project):
+    delete = closure.delete()
+    if projectId is not None:
+        delete = delete.where(closure.c.project_id == projectId)
+    if tasks is not None:
+        delete = delete.where(closure.c.task.in_(tasks))
+    conn.execute(delete)
+    conn.execute(closure.insert().from_select(['project_id', 'task', 'work_package'], closure_select(projectId, tasks)))
+
+def rebuild_task_work_packages(projectId=None):
+    refresh_task_work_packages(db.session.connection(), projectId)
+    if projectId is not None:
+        record_write(db.session, Task_Work_Packages, projectId)
+    db.session.commit()
+
+def check_task_work_packages():
+    #Rows missing from the table, and rows that shouldn't be there, as (project_id, task, work_package):
+    conn = db.session.connection()
+    expected = set(tuple(row) for row in conn.execute(closure_select()))
+    stored = set(tuple(row) for row in conn.execute(select(closure.c.project_id, closure.c.task, closure.c.work_package)))
+    return sorted(expected-stored), sorted(stored-expected)
+
+def task_work_packages(projectId, task):
+    return [wp for wp, in db.session.query(Task_Work_Packages.work_package)
+            .filter_by(project_id=projectId,task=task).order_by(Task_Work_Packages.work_package)]
+
+def changed_values(obj, name):
+    #Current and previous values of an attribute (both, if it has changed in this flush):
+    history = inspect(obj).attrs[name].history
+    return set(history.added or history.unchanged or ()) | set(history.deleted or ())
+
+@event.listens_for(db.session, 'after_flush')
+def _refresh_on_write(session, flush_context):
+    affected = {} #project id -> codes of the tasks whose rows need recomputing
+    changedDelivs = {} #project id -> deliverable codes whose links' tasks need recomputing
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Tasks2Deliverables):
+            affected.setdefault(obj.project_id, set()).update(changed_values(obj, 'task'))
+        elif isinstance(obj, Deliverables) and (obj in session.deleted or
+                inspect(obj).attrs.work_package.history.has_changes() or inspect(obj).attrs.code.history.has_changes()):
+            changedDelivs.setdefault(obj.project_id, set()).update(changed_values(obj, 'code'))
+    if not affected and not changedDelivs:
+        return
+    conn = session.connection()
+    for projectId, codes in changedDelivs.items():
+        tasks = conn.execute(select(links.c.task).where((links.c.project_id == projectId) & links.c.deliverable.in_(codes)))
+        affected.setdefault(projectId, set()).update(task for task, in tasks)
+    for projectId, tasks in affected.items():
+        if tasks:
+            refresh_task_work_packages(conn, projectId, sorted(tasks))
+            record_write(session, Task_Work_Packages, projectId)
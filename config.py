@@ -1,4 +1,45 @@
 import os
+from sqlalchemy.pool import QueuePool
+
+def env_setting(name, default):
+    #Setting from an environment variable (if set), of the same type as the default:
+    if name not in os.environ:
+        return default
+    if isinstance(default, bool):
+        return os.environ[name].lower() in ('1', 'true', 'yes')
+    return type(default)(os.environ[name])
+
+def engine_options(url, pool):
+    #Engine options for the database backend given by DATABASE_URL, with connection pool
+    #settings (pool_size, max_overflow, pool_pre_ping, pool_recycle) from the config class:
+    options = dict(pool)
+    if url.startswith('sqlite'):
+        #Embedded SQLite: share connections between threads, wait up to 30s for the write lock
+        #instead of failing, and keep a small pool of open connections (see also the PRAGMAs
+        #set on connect in SWIFTDBApp.py):
+        options.update({'connect_args': {'check_same_thread': False, 'timeout': 30},
+                        'poolclass': QueuePool})
+    return options
+
+#Measured throughput (requests/s, two 60s runs each) of
+#$ python loadtest.py run --users 20 --duration 60 --start
+#with ProductionConfig, WEB_CONCURRENCY=2 (unless stated), PostgreSQL on the same 1-CPU machine:
+#   GUNICORN_WORKER_CLASS=sync                               62.5, 56.1
+#   GUNICORN_WORKER_CLASS=sync, WEB_CONCURRENCY=4            66.2, 49.0
+#   gevent, DB_POOL_SIZE=4, DB_MAX_OVERFLOW=2 (production)   49.6, 53.0
+#   gevent, DB_POOL_SIZE=1, DB_MAX_OVERFLOW=0                44.0, 47.7
+#   gevent, DB_POOL_SIZE=2, DB_MAX_OVERFLOW=0                63.4, 50.9
+#   gevent, DB_POOL_SIZE=10, DB_MAX_OVERFLOW=10              53.8, 50.5
+#The differences are mostly within the run-to-run noise: with the database a local socket away,
+#the workers are CPU-bound and gevent has little waiting to overlap. Only a single pooled
+#connection per gevent worker is consistently slower (requests queue for it).
+def pool_settings(pool_size, max_overflow, pool_pre_ping, pool_recycle):
+    #Connection pool settings (per gunicorn worker process), each overridable by an
+    #environment variable (DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_PRE_PING, DB_POOL_RECYCLE):
+    return {'pool_size': env_setting('DB_POOL_SIZE', pool_size),
+            'max_overflow': env_setting('DB_MAX_OVERFLOW', max_overflow),
+            'pool_pre_ping': env_setting('DB_POOL_PRE_PING', pool_pre_ping),
+            'pool_recycle': env_setting('DB_POOL_RECYCLE', pool_recycle)}
 
 class Config(object):
     DEBUG = False
@@ -8,9 +49,31 @@ class Config(object):
     ADMIN_PWD = os.environ['ADMIN_PWD']
     SQLALCHEMY_DATABASE_URI = os.environ['DATABASE_URL']
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    #SQLAlchemy defaults (pool_recycle=-1 means never recycle connections):
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(os.environ['DATABASE_URL'], pool_settings(5, 10, False, -1))
+    #Optional read replica (see routing.py):
+    if 'DATABASE_READ_URL' in os.environ:
+        SQLALCHEMY_BINDS = {'read': os.environ['DATABASE_READ_URL']}
+    REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS',10)) #Read from the primary for this long after a write
+    ANALYTICS_CACHE_SECONDS = 300
+    TIMELINE_PAGE_SIZE = 50 #Items per page of a timeline month
+    DIGEST_MONTHS = int(os.environ.get('DIGEST_MONTHS',3)) #Items due within this many months are 'due soon'
+    COMPRESS_MIN_BYTES = 1024 #Compress HTML/JSON responses larger than this
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR') #Compiled templates (defaults to the temp directory)
+    REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS',2)) #Reports built at once by each worker (see reports.py)
+    REPORT_POLL_SECONDS = 2 #How often the worker checks for queued reports
+    REPORT_MEMORY_MB = int(os.environ.get('REPORT_MEMORY_MB',0)) #Address space limit of each report build process (0: no limit)
+    REPORT_TIMEOUT_MINUTES = 60 #Reports still running after this long (e.g. after a restart) are queued again
+    REPORT_KEEP_DAYS = 7 #Built reports are deleted after this long
+    CPU_TIME_HEADER = env_setting('CPU_TIME_HEADER', False) #Send each request's CPU time in an X-CPU-Time header (see loadtest.py)
+    PROJECT_START_DATE = os.environ.get('PROJECT_START_DATE','2017-08-01') #Date of project month 0
 
 class ProductionConfig(Config):
     DEBUG = False
+    #Heroku Postgres limits connections (20 on the hobby plans), shared by every worker of
+    #every dyno, so keep the pool small, check connections before use (Heroku drops idle ones
+    #during maintenance) and recycle them every 5 minutes:
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(os.environ['DATABASE_URL'], pool_settings(4, 2, True, 300))
 
 class DevelopmentConfig(Config):
     DEVELOPMENT = True
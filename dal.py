@@ -0,0 +1,51 @@
+"""
+Data access for the lookups made on nearly every request.
+
+Rows are fetched by primary key with Session.get, using the integer ids from the URL (the
+routes take <int:id>). A row already loaded in the request's session (e.g. the active project,
+or every project once the project switcher has been rendered) comes straight from the identity
+map without a query; otherwise it is a single SELECT by primary key.
+
+The other recurring lookups - a user by username, a user's work package and partner grants in
+a project, and the deliverables of a work package - use SELECT statements built once, here,
+with bound parameters. SQLAlchemy keeps each statement's cache key with it and the compiled SQL
+in the engine's statement cache, so a request only binds the values instead of building,
+keying and (on a cache miss) compiling a new query each time.
+"""
+
+from sqlalchemy import select, bindparam
+
+from SWIFTDBApp import db
+from models import Users, Users2Work_Packages, Users2Partners, Deliverables
+
+delivs = Deliverables.__table__
+
+userByUsername = select(Users).where(Users.username == bindparam('username'))
+userWPGrants = select(Users2Work_Packages.work_package).where(
+    (Users2Work_Packages.project_id == bindparam('project_id')) & (Users2Work_Packages.username == bindparam('username'))) \
+    .order_by(Users2Work_Packages.id)
+userPartnerGrants = select(Users2Partners.partner).where(
+    (Users2Partners.project_id == bindparam('project_id')) & (Users2Partners.username == bindparam('username'))) \
+    .order_by(Users2Partners.id)
+wpDeliverables = select(delivs).where((delivs.c.project_id == bindparam('project_id')) & (delivs.c.work_package == bindparam('work_package'))) \
+    .order_by(delivs.c.id)
+
+def get_row(model, id, projectId=None):
+    #Row by primary key, or None if there isn't one (or it belongs to another project):
+    row = db.session.get(model, id)
+    if row is None or (projectId is not None and row.project_id != projectId):
+        return None
+    return row
+
+def user_by_username(username):
+    return db.session.execute(userByUsername, {'username': username}).scalars().first()
+
+def user_work_packages(projectId, username):
+    return db.session.execute(userWPGrants, {'project_id': projectId, 'username': username}).scalars().all()
+
+def user_partners(projectId, username):
+    return db.session.execute(userPartnerGrants, {'project_id': projectId, 'username': username}).scalars().all()
+
+def work_package_deliverables(projectId, workPackage):
+    #Statement and parameters, for psql_rows:
+    return wpDeliverables, {'project_id': projectId, 'work_package': workPackage}
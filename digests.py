@@ -0,0 +1,68 @@
+"""
+Per-user digests of overdue and soon-due deliverables and tasks, shown on the home page.
+
+A user's items are those they can edit: deliverables of their work packages or partners, and
+tasks of their partners or linked to deliverables of their work packages. An item is overdue if
+its month_due is before the current project month and it is not 100% complete, and due soon if
+it is due within the next DIGEST_MONTHS months (including this month).
+
+The digests are recomputed for every project by:
+$ python manage.py digests
+or on Heroku (e.g. daily via the Heroku Scheduler add-on):
+$ heroku run python manage.py digests
+Each run joins all items against all access grants in one pass (pandas hash joins), so it
+scales linearly with the number of users and items.
+"""
+
+import pandas as pd
+
+from SWIFTDBApp import db, psql_to_pandas
+from models import Deliverables, Tasks, Task_Work_Packages, Users2Work_Packages, Users2Partners, Digests
+
+def compute_digests(project, month, monthsAhead):
+    #Open items due up to monthsAhead months from now:
+    cols = ['id','code','month_due','percent']
+    delivs = psql_to_pandas(Deliverables.query.filter_by(project_id=project.id)
+        .filter(Deliverables.month_due < month+monthsAhead, Deliverables.percent < 100)
+        .with_entities(*[getattr(Deliverables,c) for c in cols+['work_package','responsible_partner']]))
+    tasks = psql_to_pandas(Tasks.query.filter_by(project_id=project.id)
+        .filter(Tasks.month_due < month+monthsAhead, Tasks.percent < 100)
+        .with_entities(*[getattr(Tasks,c) for c in cols+['responsible_partner']]))
+    #Access grants, and the work packages of each task (see closure.py):
+    wpGrants = psql_to_pandas(Users2Work_Packages.query.filter_by(project_id=project.id)
+        .with_entities(Users2Work_Packages.username,Users2Work_Packages.work_package))
+    partnerGrants = psql_to_pandas(Users2Partners.query.filter_by(project_id=project.id)
+        .with_entities(Users2Partners.username,Users2Partners.partner))
+    taskWPs = psql_to_pandas(Task_Work_Packages.query.filter_by(project_id=project.id)
+        .with_entities(Task_Work_Packages.task,Task_Work_Packages.work_package))
+    #Each user's items, via either kind of grant:
+    userItems = pd.concat([
+        delivs.merge(wpGrants,on='work_package')[['username']+cols].assign(item_type='Deliverables'),
+        delivs.merge(partnerGrants,left_on='responsible_partner',right_on='partner')[['username']+cols].assign(item_type='Deliverables'),
+        tasks.merge(partnerGrants,left_on='responsible_partner',right_on='partner')[['username']+cols].assign(item_type='Tasks'),
+        tasks.merge(taskWPs,left_on='code',right_on='task').merge(wpGrants,on='work_package')[['username']+cols].assign(item_type='Tasks')])
+    userItems = userItems.drop_duplicates(['username','item_type','code'])
+    userItems['status'] = 'due soon'
+    userItems.loc[userItems['month_due'] < month,'status'] = 'overdue'
+    return userItems.rename(columns={'id':'item_id'})
+
+def store_digests(project, month, monthsAhead):
+    #Replace the project's digests in one transaction:
+    userItems = compute_digests(project, month, monthsAhead)
+    rows = [{'project_id': project.id, 'username': r.username, 'item_type': r.item_type, 'item_id': int(r.item_id),
+             'code': r.code, 'month_due': int(r.month_due), 'percent': int(r.percent), 'status': r.status,
+             'project_month': month} for r in userItems.itertuples()]
+    try:
+        Digests.query.filter_by(project_id=project.id).delete(synchronize_session=False)
+        if rows:
+            db.session.execute(Digests.__table__.insert(), rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(rows), userItems['username'].nunique()
+
+def user_digest(project, username):
+    #A user's stored digest items, overdue first:
+    return Digests.query.filter_by(project_id=project.id,username=username) \
+        .order_by(Digests.status.desc(),Digests.month_due,Digests.item_type,Digests.code).all()
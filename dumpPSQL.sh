@@ -5,6 +5,10 @@ $ bash dumpPSQL.sh
 This will make a backup copy of the current SWIFT database.
 Files created: [tableName].csv
 Users table not dumped as contains (sha-encrypted) passwords
+
+NB: each table is copied separately, so files may be inconsistent if edits are made
+during the dump. For a consistent backup of all tables that can be restored, use:
+$ python manage.py backup
 '
 
 psql SWIFTDB <<EOF
@@ -0,0 +1,35 @@
+"""
+Gunicorn settings (used by the Procfile: gunicorn -c gunicorn_config.py SWIFTDBApp:app).
+
+By default each worker is a gevent worker, serving many requests at once as greenlets, so a
+request waiting on the database (or on password hashing, see offload() in SWIFTDBApp.py)
+doesn't hold up the whole worker. psycopg2 is made cooperative with psycogreen, so queries
+yield to other greenlets while waiting for PostgreSQL. Requests only run concurrently up to
+the size of the connection pool (DB_POOL_SIZE + DB_MAX_OVERFLOW, see config.py), after which
+they queue for a connection.
+
+Environment variables:
+WEB_CONCURRENCY          number of worker processes (set by Heroku according to dyno size)
+GUNICORN_WORKER_CLASS    gevent (default), eventlet, or sync for one request per worker
+GUNICORN_CONNECTIONS     maximum simultaneous requests per gevent/eventlet worker
+"""
+
+import os
+
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+worker_connections = int(os.environ.get('GUNICORN_CONNECTIONS', 100))
+timeout = 30
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+
+def post_fork(server, worker):
+    #Make psycopg2 wait for PostgreSQL cooperatively (gunicorn has already monkey patched
+    #the standard library for gevent/eventlet workers):
+    if not os.environ.get('DATABASE_URL', '').startswith('postgres'):
+        return
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    elif worker_class == 'eventlet':
+        from psycogreen.eventlet import patch_psycopg
+        patch_psycopg()
@@ -0,0 +1,438 @@
+"""
+Load test simulating reporting-deadline traffic: many partner leaders logging in at once to view
+their partner summaries and update the progress of their deliverables and tasks.
+
+First create the load-test users (lt001, lt002, ..., password 'loadtest') in the local database,
+each leader of one partner and (every third user) one work package of the project:
+$ python loadtest.py seed --users 40
+Then, with the app running locally (e.g. $ gunicorn -c gunicorn_config.py SWIFTDBApp:app),
+or letting the script start gunicorn itself with --start:
+$ python loadtest.py run --users 40 --duration 60 [--start]
+Each simulated user logs in and then repeatedly either views one of its partner summaries, or
+opens and submits the edit form of one of its deliverables or tasks (--edit-fraction of the time),
+with a new random percent complete. Throughput, p50/p99 latency and errors are reported per
+endpoint, along with database lock waits sampled during the run (PostgreSQL: sessions waiting
+on a lock in pg_stat_activity, every 0.1s; SQLite: the write lock being held, only every second
+by default, as each check takes the lock briefly; see --lock-interval). Edits that conflict with
+another user's (the merge view, HTTP 409) are counted separately from errors, and the number of
+saved edits is checked against the increase in the rows' version numbers, so that any lost
+updates are reported. If the app sends each request's CPU time (CPU_TIME_HEADER=1, set
+automatically with --start), the mean CPU time per request is reported too; it is exact with
+one request per worker (GUNICORN_WORKER_CLASS=sync), while with gevent workers it includes
+other requests' work done meanwhile. Results are saved as JSON in
+loadtest_results/, named by git commit, and two result files can be compared using:
+$ python loadtest.py compare loadtest_results/<before>.json loadtest_results/<after>.json
+
+The same environment variables as the app (DATABASE_URL etc.) must be set, as the script reads
+the users' access settings from the database.
+"""
+
+import argparse
+import datetime as dt
+import http.client
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from html.parser import HTMLParser
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+from SWIFTDBApp import app, db, Projects, Partners, Work_Packages, Deliverables, Tasks, Users, Users2Partners, Users2Work_Packages
+from passlib.hash import sha256_crypt
+
+userPrefix = 'lt'
+userPassword = 'loadtest'
+
+########## SEEDING ##########
+def seed(nUsers, projectCode):
+    project = Projects.query.filter_by(code=projectCode).first() if projectCode else Projects.query.order_by(Projects.id).first()
+    partners = [p.name for p in Partners.query.filter_by(project_id=project.id).order_by(Partners.id)]
+    wps = [wp.code for wp in Work_Packages.query.filter_by(project_id=project.id).order_by(Work_Packages.id)]
+    #Remove these users if left from a previous run (only the exact load-test names, not other users starting 'lt'):
+    usernames = [load_test_username(i) for i in range(nUsers)]
+    Users2Partners.query.filter(Users2Partners.username.in_(usernames)).delete(synchronize_session=False)
+    Users2Work_Packages.query.filter(Users2Work_Packages.username.in_(usernames)).delete(synchronize_session=False)
+    Users.query.filter(Users.username.in_(usernames)).delete(synchronize_session=False)
+    #Hash the (shared) password once:
+    password = sha256_crypt.hash(userPassword)
+    for i, username in enumerate(usernames):
+        db.session.add(Users(username,password))
+        db.session.flush()
+        db.session.add(Users2Partners(username,partners[i%len(partners)],project_id=project.id))
+        if i%3 == 0 and wps:
+            db.session.add(Users2Work_Packages(username,wps[(i//3)%len(wps)],project_id=project.id))
+    db.session.commit()
+    print("Created "+str(nUsers)+" users in project "+project.code+" (password '"+userPassword+"')")
+
+def load_test_username(i):
+    return userPrefix+str(i+1).zfill(3)
+
+def user_plans(nUsers):
+    #For each load-test user: its project, and the partner/deliverable/task ids it may view and edit:
+    plans = []
+    for i in range(nUsers):
+        username = load_test_username(i)
+        partnerGrants = Users2Partners.query.filter_by(username=username).all()
+        if not partnerGrants:
+            sys.exit("User "+username+" not found, run: python loadtest.py seed --users "+str(nUsers))
+        projectId = partnerGrants[0].project_id
+        partnerNames = [g.partner for g in partnerGrants]
+        wpCodes = [g.work_package for g in Users2Work_Packages.query.filter_by(username=username,project_id=projectId)]
+        partnerIds = [p.id for p in Partners.query.filter_by(project_id=projectId).filter(Partners.name.in_(partnerNames))]
+        delivIds = [d.id for d in Deliverables.query.filter_by(project_id=projectId).filter(
+            Deliverables.responsible_partner.in_(partnerNames) | Deliverables.work_package.in_(wpCodes))]
+        taskIds = [t.id for t in Tasks.query.filter_by(project_id=projectId).filter(Tasks.responsible_partner.in_(partnerNames))]
+        plans.append({'username': username, 'project_id': projectId,
+                      'partners': partnerIds, 'deliverables': delivIds, 'tasks': taskIds})
+    return plans
+#############################
+
+########## HTTP CLIENT ##########
+class FormParser(HTMLParser):
+    #Collects the current values of the input, select and textarea fields of a page's form:
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.fields = {}
+        self.select = None
+        self.textarea = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'input' and 'name' in attrs and attrs.get('type') != 'submit':
+            self.fields[attrs['name']] = attrs.get('value') or ''
+        elif tag == 'select':
+            self.select = attrs.get('name')
+        elif tag == 'option' and self.select and ('selected' in attrs or self.select not in self.fields):
+            self.fields[self.select] = attrs.get('value','')
+        elif tag == 'textarea':
+            self.textarea = attrs.get('name')
+            self.fields[self.textarea] = ''
+
+    def handle_endtag(self, tag):
+        if tag == 'select':
+            self.select = None
+        elif tag == 'textarea':
+            self.textarea = None
+
+    def handle_data(self, data):
+        if self.textarea:
+            self.fields[self.textarea] += data
+
+class Client(object):
+    #One simulated user, with its own keep-alive connection and session cookie:
+    def __init__(self, baseUrl, results):
+        url = urlsplit(baseUrl)
+        self.conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+        self.cookies = SimpleCookie()
+        self.results = results
+
+    def request(self, name, method, path, data=None):
+        headers = {'Cookie': '; '.join(k+'='+v.value for k,v in self.cookies.items())}
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        start = time.perf_counter()
+        try:
+            self.conn.request(method, path, body, headers)
+            response = self.conn.getresponse()
+            content = response.read()
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.results.record(name, time.perf_counter()-start, False, None)
+            return None, b''
+        elapsed = time.perf_counter()-start
+        for header in response.headers.get_all('Set-Cookie') or []:
+            self.cookies.load(header)
+        #Successful form submissions redirect, so a 200 response to a POST means it failed validation
+        #(and a 409 response that the edit conflicted with another user's, which is not an error):
+        conflict = method == 'POST' and response.status == 409
+        ok = conflict or (response.status < 400 and not (method == 'POST' and response.status == 200))
+        self.results.record(name, elapsed, ok, response, conflict)
+        return response.status, content
+
+    def login(self, username):
+        status, _ = self.request('login', 'POST', '/login', {'username': username, 'password': userPassword})
+        return status == 302
+
+    def edit(self, link, id):
+        #Open the edit form, then submit it with a new percent complete:
+        status, content = self.request(link+' GET', 'GET', '/'+link+'/'+str(id))
+        if status != 200:
+            return
+        parser = FormParser()
+        parser.feed(content.decode('utf-8'))
+        fields = parser.fields
+        #Always change the value, so that every saved edit increments the row's version:
+        fields['percent'] = str(random.choice([p for p in range(101) if str(p) != fields.get('percent')]))
+        status, _ = self.request(link+' POST', 'POST', '/'+link+'/'+str(id), fields)
+        if status == 302:
+            self.results.record_save()
+#################################
+
+########## RESULTS ##########
+class Results(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.conflicts = {}
+        self.cpuTimes = {}
+        self.saves = 0
+
+    def record(self, name, elapsed, ok, response, conflict=False):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+            self.errors.setdefault(name, 0)
+            self.conflicts.setdefault(name, 0)
+            if not ok:
+                self.errors[name] += 1
+            if conflict:
+                self.conflicts[name] += 1
+            cpuTime = response.getheader('X-CPU-Time') if response is not None else None
+            if cpuTime is not None:
+                self.cpuTimes.setdefault(name, []).append(float(cpuTime))
+
+    def record_save(self):
+        with self.lock:
+            self.saves += 1
+
+    def summary(self, duration):
+        endpoints = {}
+        for name in sorted(self.latencies):
+            times = sorted(self.latencies[name])
+            endpoints[name] = {'requests': len(times),
+                               'errors': self.errors[name],
+                               'conflicts': self.conflicts[name],
+                               'error_rate': round(self.errors[name]/len(times),4),
+                               'throughput': round(len(times)/duration,2),
+                               'p50_ms': round(percentile(times,50)*1000,1),
+                               'p99_ms': round(percentile(times,99)*1000,1)}
+            if name in self.cpuTimes:
+                endpoints[name]['cpu_ms'] = mean_cpu(self.cpuTimes[name])
+        allTimes = sorted(t for times in self.latencies.values() for t in times)
+        nErrors = sum(self.errors.values())
+        total = {'requests': len(allTimes), 'errors': nErrors, 'conflicts': sum(self.conflicts.values()),
+                 'error_rate': round(nErrors/max(len(allTimes),1),4),
+                 'throughput': round(len(allTimes)/duration,2),
+                 'p50_ms': round(percentile(allTimes,50)*1000,1),
+                 'p99_ms': round(percentile(allTimes,99)*1000,1)}
+        if self.cpuTimes:
+            total['cpu_ms'] = mean_cpu([t for times in self.cpuTimes.values() for t in times])
+        return endpoints, total
+
+def mean_cpu(times):
+    #Mean CPU time per request (milliseconds, from the X-CPU-Time header):
+    return round(sum(times)/len(times),2)
+
+def percentile(times, p):
+    #Nearest-rank percentile of a sorted list:
+    if not times:
+        return 0
+    return times[min(len(times)-1, int(len(times)*p/100.))]
+
+class LockSampler(threading.Thread):
+    #Samples database lock waits in the background while the test runs (every interval seconds;
+    #by default 0.1s for PostgreSQL and 1s for SQLite, where each sample takes the write lock):
+    def __init__(self, interval=None):
+        threading.Thread.__init__(self, daemon=True)
+        if interval is None:
+            interval = 1.0 if db.engine.dialect.name == 'sqlite' else 0.1
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.samples = 0
+        self.busy = 0
+        self.maxWaiting = 0
+
+    def run(self):
+        engine = db.engine
+        if engine.dialect.name == 'sqlite':
+            conn = sqlite3.connect(engine.url.database, timeout=0, isolation_level=None)
+        else:
+            conn = engine.raw_connection()
+            conn.autocommit = True
+        cursor = conn.cursor()
+        while not self.stopping.wait(self.interval):
+            if engine.dialect.name == 'sqlite':
+                #Is another connection holding the write lock? (If not, this holds it for a moment,
+                #and a writer arriving meanwhile waits, hence the longer interval)
+                try:
+                    cursor.execute('BEGIN IMMEDIATE')
+                    cursor.execute('ROLLBACK')
+                    waiting = 0
+                except sqlite3.OperationalError:
+                    waiting = 1
+            else:
+                cursor.execute("SELECT count(*) FROM pg_stat_activity WHERE datname = current_database() AND wait_event_type = 'Lock'")
+                waiting = cursor.fetchone()[0]
+            self.samples += 1
+            self.busy += waiting > 0
+            self.maxWaiting = max(self.maxWaiting, waiting)
+        conn.close()
+
+    def summary(self):
+        return {'samples': self.samples,
+                'busy_fraction': round(self.busy/max(self.samples,1),4),
+                'max_waiting': self.maxWaiting,
+                'interval': self.interval,
+                'measure': 'sqlite write lock held' if db.engine.dialect.name == 'sqlite' else 'pg_stat_activity lock waits'}
+#############################
+
+########## RUNNING ##########
+def simulate_user(plan, baseUrl, results, stopAt, editFraction, think, loginFailures):
+    client = Client(baseUrl, results)
+    if not client.login(plan['username']):
+        loginFailures.append(plan['username'])
+        return
+    edits = [('deliv-edit',id) for id in plan['deliverables']] + [('task-edit',id) for id in plan['tasks']]
+    while time.time() < stopAt:
+        if edits and random.random() < editFraction:
+            client.edit(*random.choice(edits))
+        else:
+            client.request('partner-summary', 'GET', '/partner-summary/'+str(random.choice(plan['partners'])))
+        if think:
+            time.sleep(random.uniform(0, 2*think))
+
+def start_gunicorn(port):
+    env = dict(os.environ, PORT=str(port), CPU_TIME_HEADER='1')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn_config.py', 'SWIFTDBApp:app'], env=env)
+    #Wait until it accepts connections:
+    for i in range(100):
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/login')
+            conn.getresponse().read()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    sys.exit("gunicorn did not start")
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'])
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def version_total():
+    #Sum of the version numbers of all deliverables and tasks (each saved edit increments one):
+    total = sum(db.session.query(db.func.coalesce(db.func.sum(model.version),0)).scalar() for model in (Deliverables, Tasks))
+    db.session.remove()
+    return total
+
+def run(args):
+    plans = user_plans(args.users)
+    versionsBefore = version_total()
+    server = start_gunicorn(args.port) if args.start else None
+    baseUrl = args.url or 'http://127.0.0.1:'+str(args.port)
+    results = Results()
+    sampler = LockSampler(args.lock_interval)
+    loginFailures = []
+    sampler.start()
+    start = time.time()
+    threads = [threading.Thread(target=simulate_user, args=(plan, baseUrl, results, start+args.duration,
+               args.edit_fraction, args.think, loginFailures)) for plan in plans]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time()-start
+    sampler.stopping.set()
+    sampler.join()
+    if server is not None:
+        server.terminate()
+        server.wait()
+    endpoints, total = results.summary(duration)
+    report = {'commit': git_commit(),
+              'time': dt.datetime.now().isoformat(timespec='seconds'),
+              'settings': {'users': args.users, 'duration': round(duration,1), 'edit_fraction': args.edit_fraction,
+                           'think': args.think, 'url': baseUrl, 'database': db.engine.dialect.name,
+                           'env': dict((k,os.environ[k]) for k in sorted(os.environ) if k.startswith(('DB_POOL','DB_MAX','GUNICORN_','WEB_CONCURRENCY','APP_SETTINGS')))},
+              'login_failures': len(loginFailures),
+              'total': total,
+              'endpoints': endpoints,
+              'lock_waits': sampler.summary(),
+              'edits': {'saved': results.saves, 'versions_added': version_total()-versionsBefore}}
+    report['edits']['lost_updates'] = report['edits']['saved'] - report['edits']['versions_added']
+    print_report(report)
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, report['commit']+'-'+dt.datetime.now().strftime('%Y%m%d-%H%M%S')+'.json')
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results saved to "+path)
+
+def print_report(report):
+    print("Commit "+report['commit']+", "+str(report['settings']['users'])+" users, "+str(report['settings']['duration'])+"s"
+          +(", "+str(report['login_failures'])+" failed logins" if report['login_failures'] else ""))
+    print("%-20s %9s %8s %9s %10s %9s %9s %9s" % ('endpoint','requests','errors','conflicts','req/s','p50 ms','p99 ms','cpu ms'))
+    for name, s in sorted(report['endpoints'].items()) + [('TOTAL', report['total'])]:
+        cpu = '%9.2f' % s['cpu_ms'] if 'cpu_ms' in s else '%9s' % '-'
+        print("%-20s %9d %8d %9d %10.2f %9.1f %9.1f %s" % (name, s['requests'], s['errors'], s.get('conflicts',0), s['throughput'], s['p50_ms'], s['p99_ms'], cpu))
+    locks = report['lock_waits']
+    print("Lock waits ("+locks['measure']+"): "+str(round(100*locks['busy_fraction'],1))+"% of "+str(locks['samples'])+" samples, max "+str(locks['max_waiting']))
+    if 'edits' in report:
+        edits = report['edits']
+        print("Edits: "+str(edits['saved'])+" saved, "+str(edits['versions_added'])+" versions added, "+str(edits['lost_updates'])+" lost updates")
+
+def compare(pathA, pathB):
+    reports = []
+    for path in (pathA, pathB):
+        with open(path) as f:
+            reports.append(json.load(f))
+    a, b = reports
+    print("A: "+a['commit']+" ("+a['time']+")   B: "+b['commit']+" ("+b['time']+")")
+    print("%-20s %-11s %10s %10s %8s" % ('endpoint','metric','A','B','change'))
+    names = sorted(set(a['endpoints']) | set(b['endpoints']))
+    for name in names + ['TOTAL']:
+        sa = a['total'] if name == 'TOTAL' else a['endpoints'].get(name)
+        sb = b['total'] if name == 'TOTAL' else b['endpoints'].get(name)
+        if sa is None or sb is None:
+            print("%-20s (only in %s)" % (name, 'A' if sb is None else 'B'))
+            continue
+        for metric in ('throughput','p50_ms','p99_ms','error_rate','cpu_ms'):
+            if metric not in sa or metric not in sb:
+                continue
+            change = (sb[metric]-sa[metric])/sa[metric]*100 if sa[metric] else 0
+            print("%-20s %-11s %10s %10s %7.1f%%" % (name, metric, sa[metric], sb[metric], change))
+    la, lb = a['lock_waits'], b['lock_waits']
+    print("%-20s %-11s %10s %10s" % ('lock waits','busy','%.1f%%' % (100*la['busy_fraction']),'%.1f%%' % (100*lb['busy_fraction'])))
+#############################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reporting-deadline load test')
+    commands = parser.add_subparsers(dest='command')
+    seedParser = commands.add_parser('seed', help='Create the load-test users')
+    seedParser.add_argument('--users', type=int, default=40)
+    seedParser.add_argument('--project', default=None, help='Project code (defaults to the first project)')
+    runParser = commands.add_parser('run', help='Run the load test')
+    runParser.add_argument('--users', type=int, default=40, help='Number of simultaneous users')
+    runParser.add_argument('--duration', type=float, default=60, help='Seconds to run for')
+    runParser.add_argument('--edit-fraction', type=float, default=0.3, help='Fraction of actions that are edits')
+    runParser.add_argument('--think', type=float, default=0, help='Mean pause between actions, in seconds')
+    runParser.add_argument('--url', default=None, help='App URL (defaults to http://127.0.0.1:PORT)')
+    runParser.add_argument('--port', type=int, default=8000)
+    runParser.add_argument('--start', action='store_true', help='Start gunicorn (with gunicorn_config.py) for the test')
+    runParser.add_argument('--out', default='loadtest_results', help='Directory for result files')
+    runParser.add_argument('--lock-interval', type=float, default=None,
+                           help='Seconds between lock samples (defaults to 0.1, or 1 for SQLite)')
+    compareParser = commands.add_parser('compare', help='Compare two result files')
+    compareParser.add_argument('before')
+    compareParser.add_argument('after')
+    args = parser.parse_args()
+    if args.command == 'compare':
+        compare(args.before, args.after)
+    elif args.command in ('seed', 'run'):
+        with app.app_context():
+            if args.command == 'seed':
+                seed(args.users, args.project)
+            else:
+                run(args)
+    else:
+        parser.print_help()
@@ -2,7 +2,7 @@ import os
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from SWIFTDBApp import app, db
+from SWIFTDBApp import app, db, currentMonth, take_snapshot, store_digests, Projects
 
 
 migrate = Migrate(app, db)
@@ -10,6 +10,76 @@ manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
+@manager.option('-p', '--project', dest='code', default=None,
+    help='Code of the project to record (defaults to all projects)')
+@manager.option('-m', '--month', dest='month', type=int, default=None,
+    help='Project month to record (defaults to the current project month)')
+def snapshot(code, month):
+    """Record percent complete of every deliverable and task for burn-up charts"""
+    projects = Projects.query.order_by(Projects.id)
+    if code is not None:
+        projects = projects.filter_by(code=code)
+    for project in projects.all():
+        projMonth = month if month is not None else currentMonth(project)
+        if not 0 <= projMonth <= project.end_month:
+            print(project.code+": month "+str(projMonth)+" is outside the project (months 0 to "+str(project.end_month)+"), nothing recorded")
+            continue
+        nItems = take_snapshot(project, projMonth)
+        print(project.code+": recorded "+str(nItems)+" items for project month "+str(projMonth))
+
+@manager.option('-p', '--project', dest='code', default=None,
+    help='Code of the project to compute digests for (defaults to all projects)')
+@manager.option('-n', '--months', dest='months', type=int, default=None,
+    help='Items due within this many months are due soon (defaults to DIGEST_MONTHS)')
+def digests(code, months):
+    """Recompute each user's digest of overdue and soon-due items for the home page"""
+    if months is None:
+        months = app.config['DIGEST_MONTHS']
+    projects = Projects.query.order_by(Projects.id)
+    if code is not None:
+        projects = projects.filter_by(code=code)
+    for project in projects.all():
+        projMonth = currentMonth(project)
+        nItems, nUsers = store_digests(project, projMonth, months)
+        print(project.code+": "+str(nItems)+" items for "+str(nUsers)+" users at project month "+str(projMonth))
+
+@manager.option('-f', '--file', dest='path', default='swiftdb-backup.tar.gz', help='Archive to write')
+def backup(path):
+    """Back up every table, under one consistent snapshot, to a .tar.gz archive"""
+    from backup import backup as backup_db
+    rowCounts = backup_db(path)
+    print("Backed up "+str(sum(rowCounts.values()))+" rows from "+str(len(rowCounts))+" tables to "+path)
+
+@manager.option('-f', '--file', dest='path', default='swiftdb-backup.tar.gz', help='Archive to restore')
+def restore(path):
+    """Replace the contents of every table with those in a backup archive"""
+    from backup import restore as restore_db
+    rowCounts = restore_db(path)
+    for name in rowCounts:
+        print(name+": "+str(rowCounts[name])+" rows")
+    print("Restored "+str(sum(rowCounts.values()))+" rows from "+path)
+
+@manager.option('-c', '--check-only', dest='checkOnly', action='store_true', default=False,
+    help="Report differences without rebuilding")
+def closure(checkOnly):
+    """Check the task_work_packages table against the task links, and rebuild it if they differ"""
+    from closure import check_task_work_packages, rebuild_task_work_packages
+    missing, extra = check_task_work_packages()
+    for projectId, task, wp in missing:
+        print("Missing: project "+str(projectId)+", task "+task+" in work package "+wp)
+    for projectId, task, wp in extra:
+        print("Extra: project "+str(projectId)+", task "+task+" in work package "+wp)
+    print(str(len(missing))+" rows missing, "+str(len(extra))+" extra")
+    if (missing or extra) and not checkOnly:
+        rebuild_task_work_packages()
+        print("Rebuilt task_work_packages")
+
+@manager.option('-w', '--workers', dest='workers', type=int, default=None,
+    help='Number of reports to build at once (defaults to REPORT_WORKERS)')
+def worker(workers):
+    """Build queued reports in the background (runs until stopped)"""
+    from reports import run_worker
+    run_worker(workers or app.config['REPORT_WORKERS'], app.config['REPORT_POLL_SECONDS'])
 
 if __name__ == '__main__':
     manager.run()
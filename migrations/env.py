@@ -70,9 +70,15 @@ def run_migrations_online():
                                 poolclass=pool.NullPool)
 
     connection = engine.connect()
+    #sqlite can't alter constraints in place, so alembic recreates tables ("batch" mode),
+    #which needs foreign key enforcement off while the tables are swapped:
+    sqlite = connection.dialect.name == 'sqlite'
+    if sqlite:
+        connection.execute('PRAGMA foreign_keys=OFF')
     context.configure(connection=connection,
                       target_metadata=target_metadata,
                       process_revision_directives=process_revision_directives,
+                      render_as_batch=sqlite,
                       **current_app.extensions['migrate'].configure_args)
 
     try:
@@ -0,0 +1,121 @@
+"""add projects table and scope all project data by project_id
+
+Revision ID: 8d2f4b6a1e07
+Revises: 5c1e9a7d2b43
+Create Date: 2026-10-18 11:40:02.518764
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2f4b6a1e07'
+down_revision = '5c1e9a7d2b43'
+branch_labels = None
+depends_on = None
+
+#Tables that become project-scoped:
+scopedTables = ['partners', 'work_packages', 'deliverables', 'tasks', 'tasks2deliverables',
+                'users2work_packages', 'users2partners', 'progress_snapshots']
+
+#Names given to the original unnamed constraints when sqlite tables are reflected in batch
+#mode (postgresql uses its own default names, listed below):
+naming_convention = {'uq': 'uq_%(table_name)s_%(column_0_name)s',
+                     'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s'}
+
+#Foreign keys onto single-column unique keys, replaced by composite keys leading on project_id:
+#(table, old postgresql name, old sqlite name, new name, columns, referred table, referred columns)
+keyFKs = [
+    ('deliverables', 'deliverables_work_package_fkey', 'fk_deliverables_work_package_work_packages',
+        'deliverables_project_id_work_package_fkey', ['work_package'], 'work_packages', ['code']),
+    ('deliverables', 'deliverables_responsible_partner_fkey', 'fk_deliverables_responsible_partner_partners',
+        'deliverables_project_id_responsible_partner_fkey', ['responsible_partner'], 'partners', ['name']),
+    ('tasks', 'tasks_responsible_partner_fkey', 'fk_tasks_responsible_partner_partners',
+        'tasks_project_id_responsible_partner_fkey', ['responsible_partner'], 'partners', ['name']),
+    ('tasks2deliverables', 'tasks2deliverables_task_fkey', 'fk_tasks2deliverables_task_tasks',
+        'tasks2deliverables_project_id_task_fkey', ['task'], 'tasks', ['code']),
+    ('tasks2deliverables', 'tasks2deliverables_deliverable_fkey', 'fk_tasks2deliverables_deliverable_deliverables',
+        'tasks2deliverables_project_id_deliverable_fkey', ['deliverable'], 'deliverables', ['code']),
+    ('users2work_packages', 'users2work_packages_work_package_fkey', 'fk_users2work_packages_work_package_work_packages',
+        'users2work_packages_project_id_work_package_fkey', ['work_package'], 'work_packages', ['code']),
+    ('users2partners', 'users2partners_partner_fkey', 'fk_users2partners_partner_partners',
+        'users2partners_project_id_partner_fkey', ['partner'], 'partners', ['name']),
+]
+
+#Unique constraints, replaced by ones leading on project_id:
+#(table, old postgresql name, old sqlite name, old columns, new name)
+uniques = [
+    ('partners', 'partners_name_key', 'uq_partners_name', ['name'], '_project_name_uc'),
+    ('work_packages', 'work_packages_code_key', 'uq_work_packages_code', ['code'], '_project_wp_code_uc'),
+    ('deliverables', 'deliverables_code_key', 'uq_deliverables_code', ['code'], '_project_deliverable_code_uc'),
+    ('tasks', 'tasks_code_key', 'uq_tasks_code', ['code'], '_project_task_code_uc'),
+    ('tasks2deliverables', '_task_deliverable_uc', '_task_deliverable_uc', ['task', 'deliverable'], '_project_task_deliverable_uc'),
+    ('users2work_packages', '_username_work_package_uc', '_username_work_package_uc', ['username', 'work_package'], '_project_username_work_package_uc'),
+    ('users2partners', '_username_partner_uc', '_username_partner_uc', ['username', 'partner'], '_project_username_partner_uc'),
+    ('progress_snapshots', '_item_type_code_uc', '_item_type_code_uc', ['item_type', 'code'], '_project_item_type_code_uc'),
+]
+
+#Indexes for the common per-project lookups not covered by the unique constraints:
+indexes = [
+    ('ix_deliverables_project_work_package', 'deliverables', ['project_id', 'work_package']),
+    ('ix_deliverables_project_partner', 'deliverables', ['project_id', 'responsible_partner']),
+    ('ix_tasks_project_partner', 'tasks', ['project_id', 'responsible_partner']),
+    ('ix_tasks2deliverables_project_deliverable', 'tasks2deliverables', ['project_id', 'deliverable']),
+]
+
+
+def upgrade():
+    sqlite = op.get_bind().dialect.name == 'sqlite'
+    projects = op.create_table('projects',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('code', sa.String(), nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('end_month', sa.Integer(), nullable=False),
+    sa.Column('start_date', sa.Date(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('code')
+    )
+    #Existing data all belongs to the original project:
+    op.bulk_insert(projects, [{'code': 'SWIFT', 'name': 'GCRF African SWIFT', 'end_month': 51}])
+    for table in scopedTables:
+        op.add_column(table, sa.Column('project_id', sa.Integer(), nullable=True))
+        op.execute("UPDATE "+table+" SET project_id = (SELECT id FROM projects WHERE code = 'SWIFT')")
+    #Drop foreign keys onto the old unique keys first (postgresql won't drop a referenced key):
+    for table, pgName, sqliteName, new, cols, refTable, refCols in keyFKs:
+        with op.batch_alter_table(table, naming_convention=naming_convention) as batch_op:
+            batch_op.drop_constraint(sqliteName if sqlite else pgName, type_='foreignkey')
+    for table in scopedTables:
+        with op.batch_alter_table(table, naming_convention=naming_convention) as batch_op:
+            batch_op.alter_column('project_id', existing_type=sa.Integer(), nullable=False)
+            batch_op.create_foreign_key(table+'_project_id_fkey', 'projects', ['project_id'], ['id'])
+            for t, pgName, sqliteName, cols, new in uniques:
+                if t == table:
+                    batch_op.drop_constraint(sqliteName if sqlite else pgName, type_='unique')
+                    batch_op.create_unique_constraint(new, ['project_id']+cols)
+    for table, pgName, sqliteName, new, cols, refTable, refCols in keyFKs:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.create_foreign_key(new, refTable, ['project_id']+cols, ['project_id']+refCols)
+    for name, table, cols in indexes:
+        op.create_index(name, table, cols)
+
+
+def downgrade():
+    sqlite = op.get_bind().dialect.name == 'sqlite'
+    for name, table, cols in indexes:
+        op.drop_index(name, table_name=table)
+    for table, pgName, sqliteName, new, cols, refTable, refCols in keyFKs:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_constraint(new, type_='foreignkey')
+    for table in scopedTables:
+        with op.batch_alter_table(table) as batch_op:
+            for t, pgName, sqliteName, cols, new in uniques:
+                if t == table:
+                    batch_op.drop_constraint(new, type_='unique')
+                    batch_op.create_unique_constraint(sqliteName if sqlite else pgName, cols)
+            batch_op.drop_constraint(table+'_project_id_fkey', type_='foreignkey')
+            batch_op.drop_column('project_id')
+    for table, pgName, sqliteName, new, cols, refTable, refCols in keyFKs:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.create_foreign_key(sqliteName if sqlite else pgName, refTable, cols, refCols)
+    op.drop_table('projects')
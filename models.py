@@ -1,20 +1,46 @@
 from SWIFTDBApp import db
+from sqlalchemy.dialects import postgresql
+
+class Projects(db.Model):
+    __tablename__ = 'projects'
+
+    id = db.Column(db.Integer,primary_key=True,autoincrement=True)
+    code = db.Column(db.String(),nullable=False,unique=True)
+    name = db.Column(db.String(),nullable=False)
+    end_month = db.Column(db.Integer,nullable=False)
+    start_date = db.Column(db.Date())
+    version = db.Column(db.Integer,nullable=False,server_default='1') #Bumped on every update; a stale update fails (optimistic concurrency)
+    __mapper_args__ = {'version_id_col': version}
+
+    def __init__(self, code, name, end_month, start_date):
+        self.code = code
+        self.name = name
+        self.end_month = end_month
+        self.start_date = start_date
+
+    def __repr__(self):
+        return '<code {}>'.format(self.code)
 
 class Partners(db.Model):
     __tablename__ = 'partners'
 
     id = db.Column(db.Integer,primary_key=True,autoincrement=True)
-    name = db.Column(db.String(),nullable=False,unique=True)
+    project_id = db.Column(db.Integer,db.ForeignKey('projects.id'),nullable=False)
+    name = db.Column(db.String(),nullable=False)
     country = db.Column(db.String())
     role = db.Column(db.String())
+    version = db.Column(db.Integer,nullable=False,server_default='1') #Bumped on every update; a stale update fails (optimistic concurrency)
     Deliverables_Rel = db.relationship('Deliverables')
     Tasks_Rel = db.relationship('Tasks')
     Users2Partners_Rel = db.relationship('Users2Partners')
+    __table_args__ = (db.UniqueConstraint('project_id', 'name', name='_project_name_uc'),)
+    __mapper_args__ = {'version_id_col': version}
 
-    def __init__(self, name, country, role):
+    def __init__(self, name, country, role, project_id=None):
         self.name = name
         self.country = country
         self.role = role
+        self.project_id = project_id
 
     def __repr__(self):
         return '<name {}>'.format(self.name)
@@ -23,14 +49,19 @@ class Work_Packages(db.Model):
     __tablename__ = 'work_packages'
 
     id = db.Column(db.Integer,primary_key=True,autoincrement=True)
-    code = db.Column(db.String(),nullable=False,unique=True)
+    project_id = db.Column(db.Integer,db.ForeignKey('projects.id'),nullable=False)
+    code = db.Column(db.String(),nullable=False)
     name = db.Column(db.String(),nullable=False)
-    Deliverables_Rel = db.relationship('Deliverables')
+    version = db.Column(db.Integer,nullable=False,server_default='1') #Bumped on every update; a stale update fails (optimistic concurrency)
+    Deliverables_Rel = db.relationship('Deliverables',viewonly=True) #project_id is written via Partners.Deliverables_Rel
     Users2Work_Packages_Rel = db.relationship('Users2Work_Packages')
+    __table_args__ = (db.UniqueConstraint('project_id', 'code', name='_project_wp_code_uc'),)
+    __mapper_args__ = {'version_id_col': version}
 
-    def __init__(self, code, name):
+    def __init__(self, code, name, project_id=None):
         self.code = code
         self.name = name
+        self.project_id = project_id
 
     def __repr__(self):
         return '<id {}>'.format(self.id)
@@ -39,16 +70,26 @@ class Deliverables(db.Model):
     __tablename__ = 'deliverables'
 
     id = db.Column(db.Integer,primary_key=True,autoincrement=True)
-    code = db.Column(db.String(),nullable=False,unique=True)
-    work_package = db.Column(db.String(),db.ForeignKey('work_packages.code'),nullable=False)
+    project_id = db.Column(db.Integer,db.ForeignKey('projects.id'),nullable=False)
+    code = db.Column(db.String(),nullable=False)
+    work_package = db.Column(db.String(),nullable=False)
     description = db.Column(db.String(),nullable=False)
-    responsible_partner = db.Column(db.String(),db.ForeignKey('partners.name'),nullable=False)
+    responsible_partner = db.Column(db.String(),nullable=False)
     month_due = db.Column(db.Integer,nullable=False)
     progress = db.Column(db.String())
     percent = db.Column(db.Integer,nullable=False)
+    version = db.Column(db.Integer,nullable=False,server_default='1') #Bumped on every update; a stale update fails (optimistic concurrency)
     Tasks2Deliverables_Rel = db.relationship('Tasks2Deliverables')
-
-    def __init__(self, code, work_package, description, responsible_partner, month_due, progress, percent):
+    __table_args__ = (db.UniqueConstraint('project_id', 'code', name='_project_deliverable_code_uc'),
+                      db.ForeignKeyConstraint(['project_id', 'work_package'], ['work_packages.project_id', 'work_packages.code']),
+                      db.ForeignKeyConstraint(['project_id', 'responsible_partner'], ['partners.project_id', 'partners.name']),
+                      db.Index('ix_deliverables_project_work_package', 'project_id', 'work_package'),
+                      db.Index('ix_deliverables_project_partner', 'project_id', 'responsible_partner'),
+                      db.Index('ix_deliverables_project_month_work_package', 'project_id', 'month_due', 'work_package'),
+                      db.Index('ix_deliverables_project_month_partner', 'project_id', 'month_due', 'responsible_partner'))
+    __mapper_args__ = {'version_id_col': version}
+
+    def __init__(self, code, work_package, description, responsible_partner, month_due, progress, percent, project_id=None):
         self.code = code
         self.work_package = work_package
         self.description = description
@@ -56,6 +97,7 @@ class Deliverables(db.Model):
         self.month_due = month_due
         self.progress = progress
         self.percent = percent
+        self.project_id = project_id
 
     def __repr__(self):
         return '<id {}>'.format(self.id)
@@ -80,13 +122,16 @@ class Users2Work_Packages(db.Model):
     __tablename__ = 'users2work_packages'
 
     id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer,db.ForeignKey('projects.id'),nullable=False)
     username = db.Column(db.String(),db.ForeignKey('users.username'),nullable=False)
-    work_package = db.Column(db.String(),db.ForeignKey('work_packages.code'),nullable=False)
-    __table_args__ = (db.UniqueConstraint('username', 'work_package', name='_username_work_package_uc'),)
+    work_package = db.Column(db.String(),nullable=False)
+    __table_args__ = (db.UniqueConstraint('project_id', 'username', 'work_package', name='_project_username_work_package_uc'),
+                      db.ForeignKeyConstraint(['project_id', 'work_package'], ['work_packages.project_id', 'work_packages.code']))
 
-    def __init__(self, username, work_package):
+    def __init__(self, username, work_package, project_id=None):
         self.username = username
         self.work_package = work_package
+        self.project_id = project_id
 
     def __repr__(self):
         return '<id {}>'.format(self.id)
@@ -95,21 +140,29 @@ class Tasks(db.Model):
     __tablename__ = 'tasks'
 
     id = db.Column(db.Integer,primary_key=True,autoincrement=True)
-    code = db.Column(db.String(),nullable=False,unique=True)
+    project_id = db.Column(db.Integer,db.ForeignKey('projects.id'),nullable=False)
+    code = db.Column(db.String(),nullable=False)
     description = db.Column(db.String(),nullable=False)
-    responsible_partner = db.Column(db.String(),db.ForeignKey('partners.name'),nullable=False)
+    responsible_partner = db.Column(db.String(),nullable=False)
     month_due = db.Column(db.Integer,nullable=False)
     progress = db.Column(db.String())
     percent = db.Column(db.Integer,nullable=False)
-    Tasks2Deliverables_Rel = db.relationship('Tasks2Deliverables')
-
-    def __init__(self, code, description, responsible_partner, month_due, progress, percent):
+    version = db.Column(db.Integer,nullable=False,server_default='1') #Bumped on every update; a stale update fails (optimistic concurrency)
+    Tasks2Deliverables_Rel = db.relationship('Tasks2Deliverables',viewonly=True) #project_id is written via Deliverables.Tasks2Deliverables_Rel
+    __table_args__ = (db.UniqueConstraint('project_id', 'code', name='_project_task_code_uc'),
+                      db.ForeignKeyConstraint(['project_id', 'responsible_partner'], ['partners.project_id', 'partners.name']),
+                      db.Index('ix_tasks_project_partner', 'project_id', 'responsible_partner'),
+                      db.Index('ix_tasks_project_month_partner', 'project_id', 'month_due', 'responsible_partner'))
+    __mapper_args__ = {'version_id_col': version}
+
+    def __init__(self, code, description, responsible_partner, month_due, progress, percent, project_id=None):
         self.code = code
         self.description = description
         self.responsible_partner = responsible_partner
         self.month_due = month_due
         self.progress = progress
         self.percent = percent
+        self.project_id = project_id
 
     def __repr__(self):
         return '<id {}>'.format(self.id)
@@ -118,13 +171,16 @@ class Users2Partners(db.Model):
     __tablename__ = 'users2partners'
 
     id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer,db.ForeignKey('projects.id'),nullable=False)
     username = db.Column(db.String(),db.ForeignKey('users.username'),nullable=False)
-    partner = db.Column(db.String(),db.ForeignKey('partners.name'),nullable=False)
-    __table_args__ = (db.UniqueConstraint('username', 'partner', name='_username_partner_uc'),)
+    partner = db.Column(db.String(),nullable=False)
+    __table_args__ = (db.UniqueConstraint('project_id', 'username', 'partner', name='_project_username_partner_uc'),
+                      db.ForeignKeyConstraint(['project_id', 'partner'], ['partners.project_id', 'partners.name']))
 
-    def __init__(self, username, partner):
+    def __init__(self, username, partner, project_id=None):
         self.username = username
         self.partner = partner
+        self.project_id = project_id
 
     def __repr__(self):
         return '<id {}>'.format(self.id)
@@ -133,13 +189,135 @@ class Tasks2Deliverables(db.Model):
     __tablename__ = 'tasks2deliverables'
 
     id = db.Column(db.Integer, primary_key=True)
-    task = db.Column(db.String(),db.ForeignKey('tasks.code'),nullable=False)
-    deliverable = db.Column(db.String(),db.ForeignKey('deliverables.code'),nullable=False)
-    __table_args__ = (db.UniqueConstraint('task', 'deliverable', name='_task_deliverable_uc'),)
-
-    def __init__(self, task, deliverable):
+    project_id = db.Column(db.Integer,db.ForeignKey('projects.id'),nullable=False)
+    task = db.Column(db.String(),nullable=False)
+    deliverable = db.Column(db.String(),nullable=False)
+    version = db.Column(db.Integer,nullable=False,server_default='1') #Bumped on every update; a stale update fails (optimistic concurrency)
+    __table_args__ = (db.UniqueConstraint('project_id', 'task', 'deliverable', name='_project_task_deliverable_uc'),
+                      db.ForeignKeyConstraint(['project_id', 'task'], ['tasks.project_id', 'tasks.code']),
+                      db.ForeignKeyConstraint(['project_id', 'deliverable'], ['deliverables.project_id', 'deliverables.code']),
+                      db.Index('ix_tasks2deliverables_project_deliverable', 'project_id', 'deliverable'))
+    __mapper_args__ = {'version_id_col': version}
+
+    def __init__(self, task, deliverable, project_id=None):
         self.task = task
         self.deliverable = deliverable
+        self.project_id = project_id
+
+    def __repr__(self):
+        return '<id {}>'.format(self.id)
+
+class Task_Work_Packages(db.Model):
+    __tablename__ = 'task_work_packages' #Derived from tasks2deliverables and deliverables (see closure.py)
+
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer,db.ForeignKey('projects.id'),nullable=False)
+    task = db.Column(db.String(),nullable=False)
+    work_package = db.Column(db.String(),nullable=False)
+    __table_args__ = (db.UniqueConstraint('project_id', 'task', 'work_package', name='_project_task_work_package_uc'),
+                      db.Index('ix_task_work_packages_project_work_package', 'project_id', 'work_package', 'task'))
+
+    def __init__(self, task, work_package, project_id=None):
+        self.task = task
+        self.work_package = work_package
+        self.project_id = project_id
+
+    def __repr__(self):
+        return '<id {}>'.format(self.id)
+
+class Progress_Snapshots(db.Model):
+    __tablename__ = 'progress_snapshots'
+
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer,db.ForeignKey('projects.id'),nullable=False)
+    item_type = db.Column(db.String(),nullable=False)
+    code = db.Column(db.String(),nullable=False)
+    work_package = db.Column(db.String())
+    responsible_partner = db.Column(db.String())
+    percents = db.Column(postgresql.ARRAY(db.SmallInteger).with_variant(db.JSON,'sqlite'),nullable=False) #One element per project month, -1 if not recorded
+    __table_args__ = (db.UniqueConstraint('project_id', 'item_type', 'code', name='_project_item_type_code_uc'),)
+
+    def __init__(self, item_type, code, work_package, responsible_partner, percents, project_id=None):
+        self.item_type = item_type
+        self.code = code
+        self.work_package = work_package
+        self.responsible_partner = responsible_partner
+        self.percents = percents
+        self.project_id = project_id
+
+    def __repr__(self):
+        return '<id {}>'.format(self.id)
+
+class Digests(db.Model):
+    __tablename__ = 'digests'
+
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer,db.ForeignKey('projects.id'),nullable=False)
+    username = db.Column(db.String(),nullable=False)
+    item_type = db.Column(db.String(),nullable=False) #'Deliverables' or 'Tasks'
+    item_id = db.Column(db.Integer,nullable=False)
+    code = db.Column(db.String(),nullable=False)
+    month_due = db.Column(db.Integer,nullable=False)
+    percent = db.Column(db.Integer)
+    status = db.Column(db.String(),nullable=False) #'overdue' or 'due soon'
+    project_month = db.Column(db.Integer,nullable=False) #Project month the digest was computed for
+    __table_args__ = (db.UniqueConstraint('project_id', 'username', 'item_type', 'code', name='_project_username_item_type_code_uc'),)
+
+    def __init__(self, username, item_type, item_id, code, month_due, percent, status, project_month, project_id=None):
+        self.username = username
+        self.item_type = item_type
+        self.item_id = item_id
+        self.code = code
+        self.month_due = month_due
+        self.percent = percent
+        self.status = status
+        self.project_month = project_month
+        self.project_id = project_id
+
+    def __repr__(self):
+        return '<id {}>'.format(self.id)
+
+class Report_Jobs(db.Model):
+    __tablename__ = 'report_jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer,db.ForeignKey('projects.id')) #None for the whole portfolio
+    partner = db.Column(db.String()) #None for all partners
+    file_format = db.Column(db.String(),nullable=False) #'xlsx' or 'access'
+    status = db.Column(db.String(),nullable=False) #'queued', 'running', 'done' or 'failed'
+    requested_by = db.Column(db.String(),nullable=False)
+    requested = db.Column(db.DateTime(),nullable=False)
+    started = db.Column(db.DateTime())
+    finished = db.Column(db.DateTime())
+    filename = db.Column(db.String())
+    size = db.Column(db.Integer)
+    error = db.Column(db.String())
+    __table_args__ = (db.Index('ix_report_jobs_status', 'status'),)
+
+    def __init__(self, file_format, requested_by, requested, project_id=None, partner=None):
+        self.file_format = file_format
+        self.status = 'queued'
+        self.requested_by = requested_by
+        self.requested = requested
+        self.project_id = project_id
+        self.partner = partner
+
+    def __repr__(self):
+        return '<id {}>'.format(self.id)
+
+class Report_Chunks(db.Model):
+    __tablename__ = 'report_chunks'
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer,db.ForeignKey('report_jobs.id'),nullable=False)
+    seq = db.Column(db.Integer,nullable=False)
+    data = db.Column(db.LargeBinary(),nullable=False)
+    __table_args__ = (db.UniqueConstraint('job_id', 'seq', name='_job_seq_uc'),)
+
+    def __init__(self, job_id, seq, data):
+        self.job_id = job_id
+        self.seq = seq
+        self.data = data
 
     def __repr__(self):
         return '<id {}>'.format(self.id)
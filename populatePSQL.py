@@ -8,13 +8,20 @@ This will populate the database with initial data contained within the .tab file
 administrator having to input all this data via the web forms.
 
 ***NB***: Running this script will first clear the tables, including any modifications that have been
-made to the data via the web app (e.g. updates to the progress and percent fields).
+made to the data via the web app (e.g. updates to the progress and percent fields). Only rows belonging
+to the project below are cleared; the project is created if it doesn't exist yet.
 """
 
 from SWIFTDBApp import db
-from SWIFTDBApp import Partners, Work_Packages, Deliverables, Users2Work_Packages, Tasks, Users2Partners, Tasks2Deliverables
+from SWIFTDBApp import Projects, Partners, Work_Packages, Deliverables, Users2Work_Packages, Tasks, Users2Partners, Tasks2Deliverables
+from closure import rebuild_task_work_packages
 import csv
 
+#Project that the .tab files belong to:
+projectCode = 'SWIFT'
+projectName = 'GCRF African SWIFT'
+projectEndMonth = 51
+
 def yes_or_no(question):
     reply = str(input(question+' (y/n): ')).lower().strip()
     if reply[0] == 'y':
@@ -30,21 +37,29 @@ modifications that have been made to the data via the web app (e.g. updates to t
 progress and percent fields. Proceed?")
 
 if(ans):
+    #Get project (creating it if necessary):
+    project = Projects.query.filter_by(code=projectCode).first()
+    if project is None:
+        project = Projects(projectCode,projectName,projectEndMonth,None)
+        db.session.add(project)
+        db.session.commit()
+    pid = project.id
+
     #Delete current data (in reverse order of foreign key relationships):
     print("Deleting current data")
-    Tasks2Deliverables.query.delete()
+    Tasks2Deliverables.query.filter_by(project_id=pid).delete()
     db.session.commit()
-    Tasks.query.delete()
+    Tasks.query.filter_by(project_id=pid).delete()
     db.session.commit()
-    Deliverables.query.delete()
+    Deliverables.query.filter_by(project_id=pid).delete()
     db.session.commit()
-    Users2Partners.query.delete()
+    Users2Partners.query.filter_by(project_id=pid).delete()
     db.session.commit()
-    Partners.query.delete()
+    Partners.query.filter_by(project_id=pid).delete()
     db.session.commit()
-    Users2Work_Packages.query.delete()
+    Users2Work_Packages.query.filter_by(project_id=pid).delete()
     db.session.commit()
-    Work_Packages.query.delete()
+    Work_Packages.query.filter_by(project_id=pid).delete()
     db.session.commit()
 
     #Copy new data (in normal order):
@@ -58,8 +73,11 @@ if(ans):
         with open(l[0], 'r') as f:
             reader = csv.reader(f, delimiter='\t')
             for row in reader:
-                db_row=l[1](*row)
+                db_row=l[1](*row,project_id=pid)
                 db.session.add(db_row)
                 db.session.commit()
 
+    #Recompute the project's task_work_packages rows (the deletes above bypass the ORM):
+    rebuild_task_work_packages(pid)
+
     print("***SUCCESS***")
@@ -7,7 +7,9 @@ This will populate the database with initial data contained within the .tab file
 administrator having to input all this data via the web forms.
 
 ***NB***: Running this script will first clear the tables, including any modifications that have been
-made to the data via the web app (e.g. updates to the progress and percent fields).
+made to the data via the web app (e.g. updates to the progress and percent fields). Only rows belonging
+to the project with code SWIFT are cleared; the project must already exist (it is created by the
+database migrations).
 '
 
 read -r -p "***WARNING***: Running this script will populate the database with initial \
@@ -18,21 +20,37 @@ if [[ "$response" == "y" ]]
 then
 
 psql SWIFTDB <<EOF
+BEGIN;
 -- Delete current data (in reverse order of foreign key relationships);
-DELETE FROM tasks2deliverables;
-DELETE FROM tasks;
-DELETE FROM deliverables;
-DELETE FROM users2partners;
-DELETE FROM partners;
-DELETE FROM users2work_packages;
-DELETE FROM work_packages;
+DELETE FROM tasks2deliverables WHERE project_id = (SELECT id FROM projects WHERE code = 'SWIFT');
+DELETE FROM tasks WHERE project_id = (SELECT id FROM projects WHERE code = 'SWIFT');
+DELETE FROM deliverables WHERE project_id = (SELECT id FROM projects WHERE code = 'SWIFT');
+DELETE FROM users2partners WHERE project_id = (SELECT id FROM projects WHERE code = 'SWIFT');
+DELETE FROM partners WHERE project_id = (SELECT id FROM projects WHERE code = 'SWIFT');
+DELETE FROM users2work_packages WHERE project_id = (SELECT id FROM projects WHERE code = 'SWIFT');
+DELETE FROM work_packages WHERE project_id = (SELECT id FROM projects WHERE code = 'SWIFT');
 
--- Copy new data (in normal order);
-\copy partners(name,country,role) FROM './partners.tab';
-\copy work_packages(code,name) FROM './work_packages.tab';
-\copy deliverables(code,work_package,description,responsible_partner,month_due,progress,percent) FROM './deliverables.tab' WITH NULL AS '';
-\copy tasks(code,description,responsible_partner,month_due,progress,percent) FROM './tasks.tab' WITH NULL AS '';
-\copy tasks2deliverables(task,deliverable) FROM './tasks2deliverables.tab';
+-- Copy new data (in normal order) into temporary tables, then into the project;
+CREATE TEMP TABLE tmp_partners (name text, country text, role text);
+CREATE TEMP TABLE tmp_work_packages (code text, name text);
+CREATE TEMP TABLE tmp_deliverables (code text, work_package text, description text, responsible_partner text, month_due integer, progress text, percent integer);
+CREATE TEMP TABLE tmp_tasks (code text, description text, responsible_partner text, month_due integer, progress text, percent integer);
+CREATE TEMP TABLE tmp_tasks2deliverables (task text, deliverable text);
+\copy tmp_partners FROM './partners.tab';
+\copy tmp_work_packages FROM './work_packages.tab';
+\copy tmp_deliverables FROM './deliverables.tab' WITH NULL AS '';
+\copy tmp_tasks FROM './tasks.tab' WITH NULL AS '';
+\copy tmp_tasks2deliverables FROM './tasks2deliverables.tab';
+INSERT INTO partners(project_id,name,country,role) SELECT p.id, t.* FROM tmp_partners t, projects p WHERE p.code = 'SWIFT';
+INSERT INTO work_packages(project_id,code,name) SELECT p.id, t.* FROM tmp_work_packages t, projects p WHERE p.code = 'SWIFT';
+INSERT INTO deliverables(project_id,code,work_package,description,responsible_partner,month_due,progress,percent) SELECT p.id, t.* FROM tmp_deliverables t, projects p WHERE p.code = 'SWIFT';
+INSERT INTO tasks(project_id,code,description,responsible_partner,month_due,progress,percent) SELECT p.id, t.* FROM tmp_tasks t, projects p WHERE p.code = 'SWIFT';
+INSERT INTO tasks2deliverables(project_id,task,deliverable) SELECT p.id, t.* FROM tmp_tasks2deliverables t, projects p WHERE p.code = 'SWIFT';
+
+-- Recompute the project's task_work_packages rows (as closure.refresh_task_work_packages does);
+DELETE FROM task_work_packages WHERE project_id = (SELECT id FROM projects WHERE code = 'SWIFT');
+INSERT INTO task_work_packages(project_id,task,work_package) SELECT DISTINCT l.project_id, l.task, d.work_package FROM tasks2deliverables l JOIN deliverables d ON d.project_id = l.project_id AND d.code = l.deliverable WHERE l.project_id = (SELECT id FROM projects WHERE code = 'SWIFT');
+COMMIT;
 EOF
 
 else
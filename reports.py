@@ -0,0 +1,273 @@
+"""
+Report snapshots of the portfolio for funders, built in the background.
+
+Two formats are available. The first is an Excel workbook (.xlsx) with one sheet per table,
+which needs the openpyxl package. The second is a zip of CSV files, one per table, in the
+layout of the MS Access import (see README.md). A report covers one of three scopes: the
+whole portfolio (all projects), one project, or one partner of a project. Admins queue
+reports on the Reports page, which records them in the report_jobs table and lists them for
+download once built.
+
+A long build shouldn't hold up a web worker, so reports are built by a separate process:
+$ python manage.py worker
+(on Heroku, the worker process in the Procfile). It polls report_jobs for queued jobs and
+builds up to REPORT_WORKERS of them at a time in a pool of processes. There is no message
+broker: a job is claimed with a conditional UPDATE, so several workers can run side by side.
+
+Rows are streamed from the database (server-side cursors on PostgreSQL) straight into a
+temporary file (openpyxl's write-only mode, or a zip entry). The finished file is stored in
+the database in chunks (report_chunks), so any web process can serve it. Memory use doesn't
+grow with the size of the report, and REPORT_MEMORY_MB optionally caps each build process.
+"""
+
+import csv
+import datetime as dt
+import io
+import re
+import signal
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from sqlalchemy import select
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+from SWIFTDBApp import app, db
+from models import Projects, Partners, Work_Packages, Deliverables, Tasks, Tasks2Deliverables, Report_Jobs, Report_Chunks
+
+#Tables in a report, in the order of the Access import:
+reportTables = [('Partners', Partners), ('Work_Packages', Work_Packages), ('Deliverables', Deliverables),
+                ('Tasks', Tasks), ('Tasks2Deliverables', Tasks2Deliverables)]
+hiddenColumns = ['project_id', 'version']
+chunkSize = 1024*1024 #Bytes per row of report_chunks
+contentTypes = {'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+               'access': 'application/zip'}
+
+def report_formats():
+    #(value, label) of the formats that can be built here:
+    formats = [('access', 'CSV files for MS Access (.zip)')]
+    if openpyxl is not None:
+        formats.insert(0, ('xlsx', 'Excel workbook (.xlsx)'))
+    return formats
+
+########## QUEUEING ##########
+def queue_report(fileFormat, username, projectId=None, partner=None):
+    job = Report_Jobs(fileFormat, username, dt.datetime.now(), project_id=projectId, partner=partner)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def recent_jobs(n=50):
+    return Report_Jobs.query.order_by(Report_Jobs.id.desc()).limit(n).all()
+
+def report_chunks(jobId):
+    #The stored file, one chunk at a time:
+    seqs = [seq for seq, in db.session.query(Report_Chunks.seq).filter_by(job_id=jobId).order_by(Report_Chunks.seq)]
+    for seq in seqs:
+        yield db.session.query(Report_Chunks.data).filter_by(job_id=jobId,seq=seq).scalar()
+
+def claim_job():
+    #Mark the oldest queued job as running, unless another worker gets there first:
+    while True:
+        job = Report_Jobs.query.filter_by(status='queued').order_by(Report_Jobs.id).first()
+        if job is None:
+            db.session.commit()
+            return None
+        claimed = Report_Jobs.query.filter_by(id=job.id,status='queued') \
+            .update({'status': 'running', 'started': dt.datetime.now()}, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return job.id
+
+def requeue_stale_jobs(minutes):
+    #Jobs left running by a worker that stopped (e.g. a dyno restart):
+    cutoff = dt.datetime.now()-dt.timedelta(minutes=minutes)
+    n = Report_Jobs.query.filter(Report_Jobs.status == 'running', Report_Jobs.started < cutoff) \
+        .update({'status': 'queued', 'started': None}, synchronize_session=False)
+    db.session.commit()
+    return n
+
+def delete_old_reports(days):
+    cutoff = dt.datetime.now()-dt.timedelta(days=days)
+    old = (Report_Jobs.requested < cutoff) & Report_Jobs.status.in_(['done', 'failed'])
+    Report_Chunks.query.filter(Report_Chunks.job_id.in_(select(Report_Jobs.id).where(old))).delete(synchronize_session=False)
+    Report_Jobs.query.filter(old).delete(synchronize_session=False)
+    db.session.commit()
+##############################
+
+########## BUILDING ##########
+def report_query(model, job, projectId=None):
+    #Column names, and a query for the project code and visible columns of each row in the report:
+    table = model.__table__
+    projects = Projects.__table__
+    columns = [c for c in table.columns if c.name not in hiddenColumns]
+    query = select(projects.c.code, *columns).select_from(table.join(projects, table.c.project_id == projects.c.id))
+    projectId = projectId if projectId is not None else job.project_id
+    if projectId is not None:
+        query = query.where(table.c.project_id == projectId)
+    if job.partner is not None:
+        query = query.where(partner_filter(model, table, job))
+    return [c.name for c in columns], query.order_by(projects.c.id, table.c.id)
+
+def partner_filter(model, table, job):
+    #A partner's report has its deliverables and tasks, with their work packages and links:
+    if model is Partners:
+        return table.c.name == job.partner
+    if model is Deliverables or model is Tasks:
+        return table.c.responsible_partner == job.partner
+    if model is Work_Packages:
+        return table.c.code.in_(select(Deliverables.work_package).where(
+            (Deliverables.project_id == job.project_id) & (Deliverables.responsible_partner == job.partner)))
+    return table.c.task.in_(select(Tasks.code).where(
+        (Tasks.project_id == job.project_id) & (Tasks.responsible_partner == job.partner)))
+
+def stream_rows(conn, query):
+    #Rows one at a time (PostgreSQL fetches them from a server-side cursor in batches):
+    return conn.execution_options(stream_results=True).execute(query)
+
+def write_xlsx(job, conn, f):
+    workbook = openpyxl.Workbook(write_only=True) #Rows are written out as they are added
+    for name, model in reportTables:
+        sheet = workbook.create_sheet(name.replace('_', ' '))
+        names, query = report_query(model, job)
+        if job.project_id is None:
+            sheet.append(['project'] + names)
+            for row in stream_rows(conn, query):
+                sheet.append(list(row))
+        else:
+            sheet.append(names)
+            for row in stream_rows(conn, query):
+                sheet.append(list(row)[1:])
+    workbook.save(f)
+
+def write_access(job, conn, f):
+    #One folder of CSV files per project (for the whole portfolio), or just the files:
+    if job.project_id is None:
+        projects = [(p.id, p.code+'/') for p in Projects.query.order_by(Projects.id)]
+    else:
+        projects = [(job.project_id, '')]
+    with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for projectId, folder in projects:
+            for name, model in reportTables:
+                names, query = report_query(model, job, projectId)
+                with archive.open(folder+model.__tablename__+'.csv', 'w') as entry:
+                    text = io.TextIOWrapper(entry, encoding='utf-8', newline='')
+                    writer = csv.writer(text)
+                    writer.writerow(names)
+                    for row in stream_rows(conn, query):
+                        writer.writerow(row[1:])
+                    text.flush()
+                    text.detach()
+
+writers = {'xlsx': write_xlsx, 'access': write_access}
+extensions = {'xlsx': '.xlsx', 'access': '.zip'}
+
+def report_filename(job):
+    parts = ['portfolio']
+    if job.project_id is not None:
+        parts = [Projects.query.get(job.project_id).code]
+    if job.partner is not None:
+        parts.append(job.partner)
+    parts.append(dt.date.today().isoformat())
+    return '-'.join(re.sub(r'[^\w.-]+', '_', p) for p in parts) + extensions[job.file_format]
+
+def store_file(jobId, f):
+    #Copy the built file into report_chunks:
+    f.seek(0)
+    seq = 0
+    size = 0
+    while True:
+        data = f.read(chunkSize)
+        if not data:
+            break
+        db.session.execute(Report_Chunks.__table__.insert(), {'job_id': jobId, 'seq': seq, 'data': data})
+        seq += 1
+        size += len(data)
+    return size
+
+def limit_memory(megabytes):
+    #Cap this process's address space, so that a runaway build fails rather than the worker:
+    if megabytes:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (megabytes*1024*1024, resource.RLIM_INFINITY))
+
+def build_report(jobId):
+    #Runs in a pool process (which stops straight away if the dyno is stopped, see run_worker):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    with app.app_context():
+        limit_memory(app.config['REPORT_MEMORY_MB'])
+        job = Report_Jobs.query.get(jobId)
+        try:
+            if job.file_format not in writers or (job.file_format == 'xlsx' and openpyxl is None):
+                raise ValueError('Report format '+job.file_format+' is not available')
+            with tempfile.TemporaryFile() as f:
+                with db.engine.connect() as conn:
+                    writers[job.file_format](job, conn, f)
+                job.filename = report_filename(job)
+                job.size = store_file(jobId, f)
+            job.status = 'done'
+        except Exception as e:
+            db.session.rollback()
+            job = Report_Jobs.query.get(jobId)
+            job.status = 'failed'
+            job.error = (type(e).__name__+': '+str(e))[:500]
+        job.finished = dt.datetime.now()
+        db.session.commit()
+        db.session.remove()
+    return jobId
+##############################
+
+########## WORKER ##########
+def stop_worker(signum, frame):
+    #Heroku stops dynos with SIGTERM:
+    raise SystemExit(0)
+
+def run_worker(nWorkers, pollSeconds):
+    n = requeue_stale_jobs(app.config['REPORT_TIMEOUT_MINUTES'])
+    if n:
+        print("Requeued "+str(n)+" stale report jobs")
+    pool = ProcessPoolExecutor(nWorkers)
+    running = {}
+    signal.signal(signal.SIGTERM, stop_worker)
+    try:
+        while True:
+            #Record the outcome of finished builds:
+            for future in [future for future in running if future.done()]:
+                jobId = running.pop(future)
+                if future.exception() is not None:
+                    #The build process itself died (e.g. killed for using too much memory):
+                    Report_Jobs.query.filter_by(id=jobId).update({'status': 'failed', 'finished': dt.datetime.now(),
+                        'error': 'Report process failed: '+str(future.exception())[:400]}, synchronize_session=False)
+                    db.session.commit()
+                    if isinstance(future.exception(), BrokenProcessPool):
+                        raise future.exception()
+                else:
+                    print("Built report "+str(jobId))
+                delete_old_reports(app.config['REPORT_KEEP_DAYS'])
+            #Start queued jobs while there are free processes:
+            jobIds = []
+            while len(running)+len(jobIds) < nWorkers:
+                jobId = claim_job()
+                if jobId is None:
+                    break
+                jobIds.append(jobId)
+            #Close this process's connections first, so that none are shared with (forked) pool processes:
+            db.session.remove()
+            db.engine.dispose()
+            for jobId in jobIds:
+                print("Building report "+str(jobId))
+                running[pool.submit(build_report, jobId)] = jobId
+            time.sleep(pollSeconds)
+    finally:
+        #Queue any unfinished jobs again, for the next worker to build:
+        db.session.rollback()
+        Report_Jobs.query.filter(Report_Jobs.id.in_(list(running.values())), Report_Jobs.status == 'running') \
+            .update({'status': 'queued', 'started': None}, synchronize_session=False)
+        db.session.commit()
+        pool.shutdown(wait=False)
+############################
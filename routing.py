@@ -0,0 +1,58 @@
+"""
+Read/write routing between the primary database and an optional read replica.
+
+If DATABASE_READ_URL is set, queries made while handling GET requests (and the choice lists
+for forms) are sent to the replica, while writes, and everything in other requests, go to the
+primary. After a user's POST, their requests stick to the primary for REPLICA_STICKY_SECONDS
+so that they see their own edits despite any replication lag.
+
+To try this locally, use a copy of an sqlite database file as the "replica":
+$ cp swiftdb.sqlite swiftdb-replica.sqlite
+$ export DATABASE_URL=sqlite:////path/to/swiftdb.sqlite
+$ export DATABASE_READ_URL=sqlite:////path/to/swiftdb-replica.sqlite
+"""
+
+import time
+from flask import request, session, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+
+def replica_configured(app):
+    return 'read' in (app.config.get('SQLALCHEMY_BINDS') or {})
+
+def sticky():
+    #Has this user written recently?
+    return session.get('primary_until', 0) > time.time()
+
+def reads_from_replica(app, anyMethod=False):
+    #Should reads in the current request go to the replica?
+    if not replica_configured(app) or not has_request_context():
+        return False
+    if not anyMethod and request.method not in ('GET', 'HEAD'):
+        return False
+    return not sticky()
+
+def make_sticky(app):
+    #Keep this user on the primary for a while after a write:
+    session['primary_until'] = time.time() + app.config['REPLICA_STICKY_SECONDS']
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and reads_from_replica(self.app):
+            return self.db.get_engine(self.app, bind='read')
+        return SignallingSession.get_bind(self, mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def read_engine(self, app=None):
+        #Engine for read-only queries from any request (e.g. form choice lists):
+        app = self.get_app(app)
+        if reads_from_replica(app, anyMethod=True):
+            return self.get_engine(app, bind='read')
+        return self.get_engine(app)
@@ -0,0 +1,136 @@
+"""
+Monthly progress snapshots, used to draw burn-up charts.
+
+Each deliverable and task has one row in the progress_snapshots table, holding an array of
+percent complete values indexed by project month (-1 where no snapshot was taken that month).
+
+Take a snapshot of every project for its current project month using:
+$ python manage.py snapshot
+or on Heroku (e.g. daily via the Heroku Scheduler add-on):
+$ heroku run python manage.py snapshot
+
+Non-admin users only see the curves of the items they can edit: those in one of their work
+packages, or with one of their partners responsible (as recorded in the latest snapshot).
+
+The curves are computed from the snapshot matrix with numpy, and cached per process, project,
+grouping (and, for non-admin users, set of work packages and partners) until the next snapshot, a change to the links between tasks and work packages, or
+a change to the project (see caching.py).
+"""
+
+from itertools import chain
+import numpy as np
+from sqlalchemy import select, union_all, type_coerce
+
+from SWIFTDBApp import db, psql_to_pandas
+from models import Projects, Deliverables, Tasks, Tasks2Deliverables, Progress_Snapshots, Task_Work_Packages
+from caching import ProjectCache, primary
+
+_cache = ProjectCache([Projects, Deliverables, Tasks2Deliverables, Task_Work_Packages, Progress_Snapshots]) #(project id, group[, wps, partners]) -> burn-up curves
+
+snapshots = Progress_Snapshots.__table__
+closure = Task_Work_Packages.__table__
+
+def take_snapshot(project, month):
+    #Load current progress and existing snapshot rows:
+    delivData = psql_to_pandas(Deliverables.query.filter_by(project_id=project.id).order_by(Deliverables.id))
+    taskData = psql_to_pandas(Tasks.query.filter_by(project_id=project.id).order_by(Tasks.id))
+    snaps = {(s.item_type,s.code): s for s in Progress_Snapshots.query.filter_by(project_id=project.id)}
+    #Record this month's percent complete against every item:
+    items = [['Deliverables',delivData],['Tasks',taskData]]
+    for itemType,DF in items:
+        for row in DF.itertuples():
+            snap = snaps.get((itemType,row.code))
+            if snap is None:
+                snap = Progress_Snapshots(itemType,row.code,None,None,[],project_id=project.id)
+                db.session.add(snap)
+            snap.work_package = getattr(row,'work_package',None)
+            snap.responsible_partner = row.responsible_partner
+            percents = list(snap.percents)
+            percents += [-1]*(project.end_month+1-len(percents)) #Pad (e.g. if the project was extended)
+            percents[month] = int(row.percent)
+            snap.percents = percents #Reassign so the change to the array is detected
+    db.session.commit()
+    return len(delivData)+len(taskData)
+
+def access_filter(access):
+    #Snapshot rows of the items a user with access=(work packages, partners) can edit (as in
+    #deliv_edit/task_edit):
+    wps, partners = access
+    taskWPs = closure.alias() #Aliased, as the wp grouping joins the table too
+    inWPs = select(taskWPs.c.id).where((taskWPs.c.project_id == snapshots.c.project_id) & (taskWPs.c.task == snapshots.c.code) &
+                                       taskWPs.c.work_package.in_(wps)).correlate(snapshots).exists()
+    return snapshots.c.responsible_partner.in_(partners) | \
+        ((snapshots.c.item_type == 'Deliverables') & snapshots.c.work_package.in_(wps)) | \
+        ((snapshots.c.item_type == 'Tasks') & inWPs)
+
+def group_query(project_id, group, percents, access=None):
+    #Percents of each snapshot row, with the group (WP or partner) it counts towards:
+    rows = snapshots.c.project_id == project_id
+    if access is not None:
+        rows = rows & access_filter(access)
+    if group == 'partner':
+        return select(percents, snapshots.c.responsible_partner.label('name')).where(rows)
+    #Deliverables count towards their own WP, tasks towards every WP they belong to (see closure.py):
+    delivs = select(percents, snapshots.c.work_package.label('name')) \
+        .where(rows & (snapshots.c.item_type == 'Deliverables'))
+    tasks = select(percents, closure.c.work_package.label('name')) \
+        .select_from(snapshots.join(closure, (closure.c.project_id == snapshots.c.project_id) & (closure.c.task == snapshots.c.code))) \
+        .where(rows & (snapshots.c.item_type == 'Tasks'))
+    return union_all(delivs, tasks)
+
+def load_snapshots(project_id, group, access=None):
+    #Group names, and the percents of every row as one flat array with the length of each row's
+    #percents (just what the curves need):
+    engine = primary()
+    percents = snapshots.c.percents
+    if engine.dialect.name == 'sqlite':
+        percents = type_coerce(percents, db.String) #JSON text such as '[0, 20, -1]', parsed by numpy below
+    with engine.connect() as conn:
+        rows = conn.execute(group_query(project_id, group, percents.label('percents'), access)).fetchall()
+    if not rows:
+        return [], None, None
+    values, names = zip(*rows)
+    if engine.dialect.name == 'sqlite':
+        texts = [t[1:-1] for t in values]
+        lengths = np.array([t.count(',')+1 if t else 0 for t in texts], dtype=np.int64)
+        flat = np.fromstring(','.join(t for t in texts if t), dtype=np.int16, sep=',')
+    else:
+        lengths = np.array([len(p) for p in values], dtype=np.int64)
+        flat = np.fromiter(chain.from_iterable(values), dtype=np.int16, count=int(lengths.sum()))
+    return [name or '' for name in names], lengths, flat
+
+def percents_matrix(lengths, flat):
+    #One row per item, one column per project month, padded with -1 (rows are as long as the
+    #project was when they were last written):
+    M = np.full((len(lengths), int(lengths.max())), -1, dtype=np.int16)
+    M[np.arange(M.shape[1]) < lengths[:,None]] = flat
+    return M
+
+def compute_curves(project, group, access=None):
+    labels, lengths, flat = load_snapshots(project.id, group, access)
+    if not labels:
+        return {'months': [], 'curves': {}}
+    M = percents_matrix(lengths, flat)
+    #Carry each item's last recorded value forward into months with no snapshot:
+    recorded = M >= 0
+    last = np.where(recorded, np.arange(M.shape[1]), 0)
+    np.maximum.accumulate(last, axis=1, out=last)
+    filled = M[np.arange(M.shape[0])[:,None], last]
+    filled[filled < 0] = 0
+    #Only plot up to the latest recorded month:
+    lastMonth = int(np.nonzero(recorded.any(axis=0))[0].max())
+    filled = filled[:,:lastMonth+1]
+    #Average percent complete per group and month, via a group indicator matrix:
+    names, inverse = np.unique(np.array(labels, dtype=str), return_inverse=True)
+    indicator = np.zeros((len(names),len(labels)))
+    indicator[inverse,np.arange(len(labels))] = 1
+    sums = indicator.dot(filled)
+    counts = indicator.sum(axis=1)
+    curves = np.round(sums/counts[:,None],1)
+    return {'months': list(range(lastMonth+1)),
+            'curves': {name: curve.tolist() for name,curve in zip(names,curves) if name}}
+
+def burnup_curves(project, group, access=None):
+    #access is None for every item, or the (work packages, partners) of a non-admin user:
+    key = (project.id, group) if access is None else (project.id, group, tuple(sorted(access[0])), tuple(sorted(access[1])))
+    return _cache.get(key, lambda: compute_curves(project, group, access))
@@ -0,0 +1,111 @@
+"""
+Project timeline: the number of deliverables and tasks due in each project month, per work package
+or per partner.
+
+The per-month counts come from a single aggregate query (GROUP BY group and month_due, over the
+(project_id, month_due, work_package/responsible_partner) indexes), held as arrays of shape
+(groups, months) and cached per process, project and grouping. Like the at-risk analytics, it
+is cleared whenever a commit changes the project, its work packages, deliverables, tasks or their
+links (see caching.py). Tasks count towards every work package they belong to (see closure.py).
+The items behind a cell are listed a page at a time.
+
+Non-admin users only see the items they can edit: those in one of their work packages, or with one
+of their partners responsible. Their timelines are cached per set of work packages and partners.
+"""
+
+import numpy as np
+from sqlalchemy import select, union_all, literal, func, case
+
+from SWIFTDBApp import db
+from models import Projects, Work_Packages, Deliverables, Tasks, Tasks2Deliverables, Task_Work_Packages
+from caching import ProjectCache, primary
+
+_cache = ProjectCache([Projects, Work_Packages, Deliverables, Tasks, Tasks2Deliverables, Task_Work_Packages]) #(project id, group[, wps, partners]) -> timeline
+
+itemTypes = ['Deliverables', 'Tasks']
+
+def group_column(group, itemType):
+    #Column naming the group of each item, and the table(s) to select it from:
+    delivs, tasks, taskWPs = Deliverables.__table__, Tasks.__table__, Task_Work_Packages.__table__
+    if itemType == 'Deliverables':
+        return (delivs.c.work_package if group == 'wp' else delivs.c.responsible_partner), delivs
+    if group == 'wp':
+        return taskWPs.c.work_package, tasks.join(taskWPs, (taskWPs.c.project_id == tasks.c.project_id) & (taskWPs.c.task == tasks.c.code))
+    return tasks.c.responsible_partner, tasks
+
+def access_filter(itemType, access):
+    #Items a user with access=(work packages, partners) can edit (as in deliv_edit/task_edit):
+    wps, partners = access
+    if itemType == 'Deliverables':
+        delivs = Deliverables.__table__
+        return delivs.c.work_package.in_(wps) | delivs.c.responsible_partner.in_(partners)
+    tasks, taskWPs = Tasks.__table__, Task_Work_Packages.__table__.alias() #Aliased, as the wp grouping joins the table too
+    inWPs = select(taskWPs.c.id).where((taskWPs.c.project_id == tasks.c.project_id) & (taskWPs.c.task == tasks.c.code) &
+                                       taskWPs.c.work_package.in_(wps)).correlate(tasks).exists()
+    return inWPs | tasks.c.responsible_partner.in_(partners)
+
+def aggregate_query(project_id, group, access=None):
+    #Item count and number complete per item type, group and month, in one query:
+    parts = []
+    for i, itemType in enumerate(itemTypes):
+        table = Deliverables.__table__ if itemType == 'Deliverables' else Tasks.__table__
+        name, source = group_column(group, itemType)
+        query = select(literal(i).label('item_type'), name.label('name'), table.c.month_due,
+                       func.count().label('n'), func.sum(case((table.c.percent >= 100, 1), else_=0)).label('complete')) \
+            .select_from(source).where(table.c.project_id == project_id).group_by(name, table.c.month_due)
+        if access is not None:
+            query = query.where(access_filter(itemType, access))
+        parts.append(query)
+    return union_all(*parts)
+
+def compute_timeline(project, group, access=None):
+    with primary().connect() as conn:
+        rows = conn.execute(aggregate_query(project.id, group, access)).fetchall()
+    names = sorted(set(row.name for row in rows))
+    nMonths = project.end_month+1
+    counts = np.zeros((len(itemTypes), len(names), nMonths), dtype=int)
+    complete = np.zeros_like(counts)
+    if rows:
+        itemIdx = np.array([row.item_type for row in rows])
+        nameIdx = np.searchsorted(names, [row.name for row in rows])
+        monthIdx = np.clip([row.month_due for row in rows], 0, nMonths-1) #Anything outside the project goes in the first/last month
+        np.add.at(counts, (itemIdx, nameIdx, monthIdx), [row.n for row in rows])
+        np.add.at(complete, (itemIdx, nameIdx, monthIdx), [int(row.complete or 0) for row in rows])
+    total = counts.sum(axis=0)
+    return {'names': names, 'months': list(range(nMonths)),
+            'deliverables': counts[0], 'tasks': counts[1], 'total': total, 'complete': complete.sum(axis=0),
+            'monthTotals': total.sum(axis=0), 'maxCount': int(total.max()) if total.size else 0}
+
+def timeline(project, group, access=None):
+    #access is None for every item, or the (work packages, partners) of a non-admin user:
+    key = (project.id, group) if access is None else (project.id, group, tuple(sorted(access[0])), tuple(sorted(access[1])))
+    return _cache.get(key, lambda: compute_timeline(project, group, access))
+
+def timeline_items(project, group, month, name=None, page=1, pageSize=50, access=None):
+    #One page of the deliverables and tasks due in a month (in one group, or all), and whether there are more:
+    delivs, tasks = Deliverables.__table__, Tasks.__table__
+    parts = []
+    for itemType, table in [('Deliverables', delivs), ('Tasks', tasks)]:
+        groupCol, source = group_column(group, itemType)
+        if name is None:
+            source = table #Each item once, even if it is in several work packages
+        wp = delivs.c.work_package if itemType == 'Deliverables' else literal(None)
+        query = select(literal(itemType).label('item_type'), table.c.id, table.c.code, table.c.description,
+                       wp.label('work_package'), table.c.responsible_partner, table.c.month_due, table.c.percent) \
+            .select_from(source).where((table.c.project_id == project.id) & month_filter(table, project, month))
+        if name is not None:
+            query = query.where(groupCol == name)
+        if access is not None:
+            query = query.where(access_filter(itemType, access))
+        parts.append(query)
+    query = union_all(*parts).order_by('item_type', 'code').limit(pageSize+1).offset((page-1)*pageSize)
+    rows = db.session.connection().execute(query).fetchall()
+    return rows[:pageSize], len(rows) > pageSize
+
+def month_filter(table, project, month):
+    #Items due in a month (including those outside the project in the first/last month, as counted above):
+    if month <= 0:
+        return table.c.month_due <= 0
+    if month >= project.end_month:
+        return table.c.month_due >= project.end_month
+    return table.c.month_due == month